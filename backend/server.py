@@ -1,32 +1,202 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks, Query, Request, Response
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from bson import json_util
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, time as clock_time, timezone, timedelta
+from zoneinfo import ZoneInfo
 from passlib.context import CryptContext
 import jwt
 import random
 from enum import Enum
 import httpx
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from cachetools import TTLCache
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import bisect
+import csv
+import hashlib
+import heapq
+import io
+import itertools
+import msgpack
+import orjson
+import time
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
+# Index registry: every query the API issues must be served by one of these.
+# Reconciled against the live collections by ensure_indexes() on startup.
+INDEX_REGISTRY = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("phone", ASCENDING)], name="phone_unique", unique=True),
+        # Also the patients export's (created_at, id) order; covers the plain role filters
+        IndexModel([("role", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="role_1_created_at_1_id_1"),
+    ],
+    "admin_users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+    "otps": [
+        # One live OTP per phone; MongoDB deletes them once expires_at passes
+        IndexModel([("phone", ASCENDING)], name="phone_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "doctors": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_1_id_1"),
+    ],
+    "services": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_1_id_1"),
+    ],
+    "appointments": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Trailing id makes each of these a keyset pagination index as well
+        IndexModel([("appointment_date", ASCENDING), ("id", ASCENDING)], name="appointment_date_1_id_1"),
+        IndexModel([("status", ASCENDING), ("appointment_date", ASCENDING), ("id", ASCENDING)], name="status_1_appointment_date_1_id_1"),
+        IndexModel([("patient_phone", ASCENDING), ("appointment_date", ASCENDING), ("id", ASCENDING)], name="patient_phone_1_appointment_date_1_id_1"),
+        IndexModel([("patient_id", ASCENDING), ("appointment_date", ASCENDING), ("id", ASCENDING)], name="patient_id_1_appointment_date_1_id_1"),
+    ],
+    "reservations": [
+        # The double-booking guard: a slot can be inserted once per doctor
+        IndexModel([("doctor_id", ASCENDING), ("slot_start", ASCENDING)], name="doctor_id_1_slot_start_unique", unique=True),
+        IndexModel([("appointment_id", ASCENDING)], name="appointment_id_1"),
+        IndexModel([("slot_start", ASCENDING)], name="slot_start_ttl", expireAfterSeconds=7 * 24 * 3600),
+    ],
+    "campaigns": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_1_id_1"),
+        IndexModel([("broadcast_at", DESCENDING), ("id", DESCENDING)], name="broadcast_at_-1_id_-1"),
+    ],
+    "campaign_deliveries": [
+        IndexModel([("campaign_id", ASCENDING), ("phone", ASCENDING)], name="campaign_id_1_phone_unique", unique=True),
+    ],
+    "notifications": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="user_id_1_created_at_-1_id_-1"),
+    ],
+    "reviews": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_1_id_1"),
+        IndexModel([("appointment_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="appointment_id_1_created_at_1_id_1"),
+    ],
+    "outbox": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_1_next_attempt_at_1"),
+        # Delivered messages are kept for a week for troubleshooting
+        IndexModel([("sent_at", ASCENDING)], name="sent_at_ttl", expireAfterSeconds=7 * 24 * 3600),
+    ],
+}
+
+# Representative query of each hot route, used by the explain endpoint to
+# prove every one of them is answered from an index.
+ROUTE_QUERIES = [
+    {"route": "POST /api/auth/admin/login", "collection": "admin_users", "filter": {"username": "admin"}},
+    {"route": "POST /api/auth/verify-otp", "collection": "otps", "filter": {"phone": "+966500000000", "otp": "000000", "expires_at": {"$gt": datetime(2030, 1, 1, tzinfo=timezone.utc)}}},
+    {"route": "POST /api/auth/verify-otp (user)", "collection": "users", "filter": {"phone": "+966500000000"}},
+    {"route": "GET /api/users/me", "collection": "users", "filter": {"id": "sample"}},
+    {"route": "catalog cache load (doctors)", "collection": "doctors", "filter": {}, "sort": {"created_at": 1, "id": 1}},
+    {"route": "catalog cache miss (doctors)", "collection": "doctors", "filter": {"id": "sample"}},
+    {"route": "catalog cache load (services)", "collection": "services", "filter": {}, "sort": {"created_at": 1, "id": 1}},
+    {"route": "GET /api/appointments", "collection": "appointments", "filter": {}, "sort": {"appointment_date": -1, "id": -1}},
+    {"route": "GET /api/appointments/{id}", "collection": "appointments", "filter": {"id": "sample"}},
+    {"route": "GET /api/appointments?status", "collection": "appointments", "filter": {"status": "confirmed"}, "sort": {"appointment_date": -1, "id": -1}},
+    {"route": "GET /api/appointments?patient_id", "collection": "appointments", "filter": {"patient_id": "sample"}, "sort": {"appointment_date": -1, "id": -1}},
+    {"route": "GET /api/appointments?patient_phone", "collection": "appointments", "filter": {"patient_phone": "+966500000000"}, "sort": {"appointment_date": -1, "id": -1}},
+    {"route": "send_automatic_reminders", "collection": "appointments", "filter": {"status": "confirmed", "appointment_date": {"$gte": datetime(2030, 1, 1, tzinfo=timezone.utc), "$lte": datetime(2030, 1, 2, tzinfo=timezone.utc)}, "reminder_24h_sent": {"$ne": True}}},
+    {"route": "GET /api/campaigns", "collection": "campaigns", "filter": {}, "sort": {"created_at": 1, "id": 1}},
+    {"route": "GET /api/campaigns/{id}/reach", "collection": "campaigns", "filter": {"id": "sample"}},
+    {"route": "POST /api/campaigns/{id}/send", "collection": "users", "filter": {"phone": {"$exists": True, "$ne": ""}}, "projection": {"_id": 0, "id": 1, "phone": 1}},
+    {"route": "POST /api/campaigns/{id}/send (delivered?)", "collection": "campaign_deliveries", "filter": {"campaign_id": "sample", "phone": "+966500000000"}},
+    {"route": "GET /api/notifications (broadcasts)", "collection": "campaigns", "filter": {"broadcast_at": {"$ne": None}}, "sort": {"broadcast_at": -1, "id": -1}},
+    {"route": "GET /api/notifications", "collection": "notifications", "filter": {"user_id": "sample"}, "sort": {"created_at": -1, "id": -1}},
+    {"route": "PUT /api/notifications/{id}/read", "collection": "notifications", "filter": {"id": "sample"}},
+    {"route": "POST /api/notifications/read", "collection": "notifications", "filter": {"user_id": "sample", "read": {"$ne": True}, "created_at": {"$lte": datetime(2030, 1, 1, tzinfo=timezone.utc)}}},
+    {"route": "GET /api/reviews", "collection": "reviews", "filter": {}, "sort": {"created_at": 1, "id": 1}},
+    {"route": "GET /api/reviews?appointment_id", "collection": "reviews", "filter": {"appointment_id": "sample"}, "sort": {"created_at": 1, "id": 1}},
+    {"route": "GET /api/export/appointments", "collection": "appointments", "filter": {"appointment_date": {"$gte": datetime(2030, 1, 1, tzinfo=timezone.utc), "$lt": datetime(2030, 2, 1, tzinfo=timezone.utc)}}, "sort": {"appointment_date": 1, "id": 1}},
+    {"route": "GET /api/export/reviews", "collection": "reviews", "filter": {"created_at": {"$gte": datetime(2030, 1, 1, tzinfo=timezone.utc)}}, "sort": {"created_at": 1, "id": 1}},
+    {"route": "GET /api/export/patients", "collection": "users", "filter": {"role": "patient"}, "sort": {"created_at": 1, "id": 1}},
+    {"route": "outbox worker claim", "collection": "outbox", "filter": {"status": {"$in": ["pending", "in_flight"]}, "next_attempt_at": {"$lte": datetime(2030, 1, 1, tzinfo=timezone.utc)}}, "sort": {"next_attempt_at": 1}},
+]
+
+async def ensure_indexes() -> dict:
+    """
+    Reconcile INDEX_REGISTRY with the database:
+    - create registered indexes that are missing
+    - report indexes that exist but are not registered (extra)
+    - report registered indexes never used since the server started (unused)
+    """
+    report = {"created": [], "failed": [], "extra": [], "unused": []}
+    
+    for collection_name, indexes in INDEX_REGISTRY.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        registered = {index.document["name"] for index in indexes}
+        
+        for index in indexes:
+            name = index.document["name"]
+            if name in existing:
+                continue
+            # Create one at a time so a bad index (e.g. duplicates under a
+            # unique key) doesn't prevent the others from being built
+            try:
+                await collection.create_indexes([index])
+                report["created"].append(f"{collection_name}.{name}")
+            except OperationFailure as e:
+                report["failed"].append({"index": f"{collection_name}.{name}", "error": str(e)})
+        
+        for name in existing:
+            if name != "_id_" and name not in registered:
+                report["extra"].append(f"{collection_name}.{name}")
+        
+        try:
+            async for stat in collection.aggregate([{"$indexStats": {}}]):
+                if stat["name"] in registered and stat["accesses"]["ops"] == 0:
+                    report["unused"].append(f"{collection_name}.{stat['name']}")
+        except OperationFailure:
+            # $indexStats needs the clusterMonitor role on some deployments
+            pass
+    
+    return report
+
+def find_collection_scans(plan: dict) -> List[str]:
+    """Return the stages of a query plan that scan a whole collection"""
+    stages = []
+    if plan.get("stage") == "COLLSCAN":
+        stages.append("COLLSCAN")
+    for key in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(key), dict):
+            stages.extend(find_collection_scans(plan[key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(find_collection_scans(child))
+    return stages
+
+# Opt-in fast path for large list responses: orjson for every response and
+# list_response() for the list routes
+FAST_RESPONSES = os.environ.get("FAST_RESPONSES", "false").lower() == "true"
+
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse if FAST_RESPONSES else JSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -39,95 +209,639 @@ ALGORITHM = "HS256"
 # OneSignal Configuration
 ONESIGNAL_APP_ID = "3adbb1be-a764-4977-a22c-0de12043ac2e"
 ONESIGNAL_REST_API_KEY = os.environ.get("ONESIGNAL_REST_API_KEY", "")  # سنحتاجه لاحقاً
+ONESIGNAL_API_URL = os.environ.get("ONESIGNAL_API_URL", "https://onesignal.com/api/v1/notifications")
+ONESIGNAL_PLAYERS_URL = os.environ.get("ONESIGNAL_PLAYERS_URL", "https://onesignal.com/api/v1/players")
+# OneSignal accepts at most this many external user ids per notification
+ONESIGNAL_MAX_EXTERNAL_IDS = 2000
+PATIENT_DASHBOARD_URL = "https://dental-booking-16.preview.emergentagent.com/patient/dashboard"
+ONESIGNAL_TIMEOUT = float(os.environ.get("ONESIGNAL_TIMEOUT", "10"))
+ONESIGNAL_CONNECT_TIMEOUT = float(os.environ.get("ONESIGNAL_CONNECT_TIMEOUT", "5"))
+ONESIGNAL_MAX_CONNECTIONS = int(os.environ.get("ONESIGNAL_MAX_CONNECTIONS", "20"))
+ONESIGNAL_KEEPALIVE_EXPIRY = float(os.environ.get("ONESIGNAL_KEEPALIVE_EXPIRY", "30"))
+
+# Shared OneSignal HTTP client, created on startup and closed on shutdown
+onesignal_client: Optional[httpx.AsyncClient] = None
+
+def create_onesignal_client() -> httpx.AsyncClient:
+    """Pooled keep-alive HTTP/2 client for the OneSignal REST API"""
+    return httpx.AsyncClient(
+        http2=True,
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Basic {ONESIGNAL_REST_API_KEY}"
+        },
+        limits=httpx.Limits(
+            max_connections=ONESIGNAL_MAX_CONNECTIONS,
+            max_keepalive_connections=ONESIGNAL_MAX_CONNECTIONS,
+            keepalive_expiry=ONESIGNAL_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(ONESIGNAL_TIMEOUT, connect=ONESIGNAL_CONNECT_TIMEOUT)
+    )
+
+async def post_onesignal(payload: dict, url: str = ONESIGNAL_API_URL, method: str = "POST") -> httpx.Response:
+    """Send a payload to the OneSignal API through the shared client"""
+    return await onesignal_client.request(method, url, json=payload)
+
+def build_push_payloads(title: str, message: str, external_ids: List[str]) -> List[dict]:
+    """Payloads addressing patients by external user id, split at OneSignal's per-request limit"""
+    return [
+        {
+            "app_id": ONESIGNAL_APP_ID,
+            "include_external_user_ids": external_ids[i:i + ONESIGNAL_MAX_EXTERNAL_IDS],
+            "channel_for_external_user_ids": "push",
+            "headings": {"en": title, "ar": title},
+            "contents": {"en": message, "ar": message},
+            "url": PATIENT_DASHBOARD_URL
+        }
+        for i in range(0, len(external_ids), ONESIGNAL_MAX_EXTERNAL_IDS)
+    ]
+
+async def resolve_patient_user_ids(appointments: List[dict]) -> dict:
+    """
+    Map appointment id -> patient user id (the OneSignal external user id).
+    Appointments booked without a patient_id (e.g. added by the admin) are
+    matched to the registered user with the same phone in one query.
+    """
+    user_ids = {}
+    by_phone = {}
+    for apt in appointments:
+        if apt.get('patient_id'):
+            user_ids[apt['id']] = apt['patient_id']
+        elif apt.get('patient_phone'):
+            by_phone.setdefault(apt['patient_phone'], []).append(apt['id'])
+    
+    if by_phone:
+        cursor = db.users.find({"phone": {"$in": list(by_phone)}}, {"_id": 0, "id": 1, "phone": 1})
+        async for user in cursor:
+            for appointment_id in by_phone[user['phone']]:
+                user_ids[appointment_id] = user['id']
+    
+    return user_ids
+
+# Notification outbox: pushes are written to the outbox collection in the
+# request path and delivered by a pool of background workers (at-least-once)
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_SECONDS = float(os.environ.get("OUTBOX_BACKOFF_SECONDS", "2"))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.environ.get("OUTBOX_MAX_BACKOFF_SECONDS", "3600"))
+OUTBOX_LEASE_SECONDS = float(os.environ.get("OUTBOX_LEASE_SECONDS", "60"))
+OUTBOX_POLL_SECONDS = float(os.environ.get("OUTBOX_POLL_SECONDS", "5"))
+
+async def enqueue_push(payload: dict, kind: str, reference: Optional[str] = None, url: Optional[str] = None, method: str = "POST") -> str:
+    """Queue a OneSignal payload for delivery and return the outbox message id"""
+    message = OutboxMessage(kind=kind, reference=reference, payload=payload, url=url, method=method)
+    await db.outbox.insert_one(to_document(message))
+    outbox_workers.notify()
+    return message.id
+
+async def enqueue_pushes(payloads: List[dict], kind: str, reference: Optional[str] = None) -> int:
+    """Queue several notification payloads with a single insert"""
+    return await enqueue_messages([OutboxMessage(kind=kind, reference=reference, payload=payload) for payload in payloads])
+
+async def enqueue_messages(messages: List["OutboxMessage"]) -> int:
+    """Queue prepared outbox messages with a single insert"""
+    if not messages:
+        return 0
+    await db.outbox.insert_many([to_document(message) for message in messages])
+    outbox_workers.notify()
+    return len(messages)
+
+class OutboxWorkerPool:
+    """
+    Drains the outbox with a pool of asyncio workers.
+    
+    A worker claims a message by moving it to in_flight and pushing its
+    next_attempt_at out by the lease; if the worker dies mid-send the lease
+    runs out and another worker claims it again. Failed sends are retried with
+    exponential backoff and dead-lettered after OUTBOX_MAX_ATTEMPTS.
+    """
+    
+    def __init__(self, size: int):
+        self.size = size
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+    
+    def notify(self):
+        self._wakeup.set()
+    
+    def start(self):
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.size)]
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await db.outbox.find_one_and_update(
+            {"status": {"$in": ["pending", "in_flight"]}, "next_attempt_at": {"$lte": now}},
+            {
+                "$set": {"status": "in_flight", "next_attempt_at": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("next_attempt_at", ASCENDING)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def _run(self):
+        while True:
+            try:
+                message = await self._claim()
+            except Exception as e:
+                print(f"❌ Error claiming outbox message: {e}")
+                message = None
+            
+            if message is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            await self._deliver(message)
+    
+    async def _deliver(self, message: dict):
+        retryable = True
+        try:
+            response = await post_onesignal(
+                message['payload'], message.get('url') or ONESIGNAL_API_URL, message.get('method') or "POST"
+            )
+            if response.status_code == 200:
+                await db.outbox.update_one(
+                    {"id": message['id']},
+                    {"$set": {"status": "sent", "sent_at": datetime.now(timezone.utc)}}
+                )
+                print(f"✅ Push sent ({message['kind']} {message.get('reference') or ''})")
+                return
+            error = f"HTTP {response.status_code}: {response.text}"
+            # Anything but rate limiting and server errors won't succeed on retry
+            retryable = response.status_code == 429 or response.status_code >= 500
+        except Exception as e:
+            error = str(e)
+        
+        if not retryable or message['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            await db.outbox.update_one(
+                {"id": message['id']},
+                {"$set": {"status": "dead", "last_error": error}}
+            )
+            print(f"❌ Push dead-lettered after {message['attempts']} attempts ({message['kind']}): {error}")
+            return
+        
+        backoff = min(OUTBOX_BACKOFF_SECONDS * 2 ** (message['attempts'] - 1), OUTBOX_MAX_BACKOFF_SECONDS)
+        backoff *= random.uniform(0.8, 1.2)
+        await db.outbox.update_one(
+            {"id": message['id']},
+            {"$set": {
+                "status": "pending",
+                "next_attempt_at": datetime.now(timezone.utc) + timedelta(seconds=backoff),
+                "last_error": error
+            }}
+        )
+        print(f"⚠️ Push failed, retrying in {backoff:.0f}s ({message['kind']}): {error}")
+
+outbox_workers = OutboxWorkerPool(OUTBOX_WORKERS)
 
 # Scheduler for automatic reminders
 scheduler = AsyncIOScheduler()
 
+# Reminder windows, in hours before the appointment. A reminder becomes due
+# end_hours before the appointment and can still be caught up (e.g. after a
+# restart) until start_hours before it. The tolerance is kept small so the text
+# stays true: an appointment confirmed 5 hours ahead must not be told "tomorrow".
+# Each window is served by one range query on the (status, appointment_date) index.
+REMINDER_WINDOWS = [
+    {
+        "label": "24h",
+        "flag": "reminder_24h_sent",
+        "start_hours": 20,
+        "end_hours": 24,
+        "title": "تذكير: موعدك غداً 📅",
+        "message": "موعدك مع د. {doctor_name} غداً في تمام الساعة {time}\n\nنتطلع لرؤيتك 🦷",
+    },
+    {
+        "label": "3h",
+        "flag": "reminder_3h_sent",
+        "start_hours": 2,
+        "end_hours": 3,
+        "title": "تذكير: موعدك بعد 3 ساعات ⏰",
+        "message": "موعدك مع د. {doctor_name} بعد 3 ساعات\n📍 عيادات الغصاب\n⏰ {time}\n\nنراك قريباً 😊",
+    },
+]
+REMINDER_BATCH_SIZE = 500
+REMINDER_CONCURRENCY = int(os.environ.get("REMINDER_CONCURRENCY", "8"))
+
+# Throughput of the latest reminder run, reported by the metrics endpoint
+last_reminder_run = {}
+
+# Serializes the timer engine and the periodic sweep within a worker; across
+# workers each appointment is claimed in MongoDB before its reminder is queued
+reminder_lock = asyncio.Lock()
+
+def reminder_window_query(window: dict, now: datetime) -> dict:
+    """Confirmed appointments inside a reminder window that weren't reminded yet"""
+    return {
+        "status": "confirmed",
+        "appointment_date": {
+            "$gte": now + timedelta(hours=window["start_hours"]),
+            "$lte": now + timedelta(hours=window["end_hours"])
+        },
+        window["flag"]: {"$ne": True}
+    }
+
+async def claim_reminders(window: dict, appointments: List[dict]) -> tuple:
+    """
+    Set the window's sent flag on the appointments no one has claimed yet.
+    Returns (claim token, the appointments this call won); other workers
+    running the same window only get the ones still unflagged.
+    """
+    token = str(uuid.uuid4())
+    claim_field = f"reminder_claims.{window['label']}"
+    await db.appointments.update_many(
+        {"id": {"$in": [apt['id'] for apt in appointments]}, window["flag"]: {"$ne": True}},
+        {"$set": {window["flag"]: True, claim_field: token}}
+    )
+    won = set()
+    async for apt in db.appointments.find({"id": {"$in": [apt['id'] for apt in appointments]}, claim_field: token}, {"_id": 0, "id": 1}):
+        won.add(apt['id'])
+    return token, [apt for apt in appointments if apt['id'] in won]
+
+async def release_reminders(window: dict, token: str):
+    """Clear the sent flag of a claim whose pushes couldn't be queued, so a later run retries them"""
+    await db.appointments.update_many(
+        {f"reminder_claims.{window['label']}": token},
+        {"$set": {window["flag"]: False}}
+    )
+
+async def dispatch_reminders(window: dict, query: dict, semaphore: asyncio.Semaphore) -> int:
+    """
+    Queue the window's reminder for every appointment matching query.
+    Batches are sent concurrently (bounded by semaphore); each batch is
+    claimed first, so only one worker queues a given appointment's push.
+    """
+    tasks = []
+    
+    async def send(batch: List[dict]) -> int:
+        token = None
+        try:
+            token, claimed = await claim_reminders(window, batch)
+            if claimed:
+                await send_reminder_batch(window, claimed)
+            return len(claimed)
+        except Exception:
+            if token:
+                await release_reminders(window, token)
+            raise
+        finally:
+            semaphore.release()
+    
+    batch = []
+    # Stream the window's appointments instead of loading every confirmed one
+    cursor = db.appointments.find(query, {"_id": 0}).batch_size(REMINDER_BATCH_SIZE)
+    async for apt in cursor:
+        batch.append(apt)
+        if len(batch) >= REMINDER_BATCH_SIZE:
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(send(batch)))
+            batch = []
+    if batch:
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(send(batch)))
+    
+    sent = 0
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            # Left unflagged, so the next run picks these appointments up again
+            print(f"❌ Error sending {window['label']} reminder batch: {result}")
+            continue
+        sent += result
+    
+    return sent
+
+async def send_reminder_batch(window: dict, appointments: List[dict]):
+    """Queue one push per distinct reminder text, addressed to all its patients"""
+    user_ids = await resolve_patient_user_ids(appointments)
+    
+    # Patients with the same doctor and time get the same text and share a push
+    recipients = {}
+    for apt in appointments:
+        if apt['id'] not in user_ids:
+            print(f"⚠️ No registered user for appointment {apt['id']}, skipping push")
+            continue
+        message = window["message"].format(
+            doctor_name=apt['doctor_name'], time=apt['appointment_date'].strftime('%I:%M %p')
+        )
+        recipients.setdefault(message, []).append(user_ids[apt['id']])
+    
+    payloads = []
+    for message, external_ids in recipients.items():
+        payloads.extend(build_push_payloads(window["title"], message, external_ids))
+    await enqueue_pushes(payloads, "reminder", window["label"])
+
+async def run_reminder_windows(queries: List[tuple], source: str):
+    """Dispatch (window, query) pairs concurrently"""
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(REMINDER_CONCURRENCY)
+    sent = sum(await asyncio.gather(*(dispatch_reminders(window, query, semaphore) for window, query in queries)))
+    
+    duration = time.perf_counter() - started
+    last_reminder_run.update({
+        "source": source,
+        "finished_at": datetime.now(timezone.utc),
+        "reminders": sent,
+        "duration_seconds": round(duration, 3),
+        "reminders_per_second": round(sent / duration, 1) if duration > 0 else 0.0
+    })
+    if sent:
+        print(f"✅ Sent {sent} reminders in {duration:.2f}s ({last_reminder_run['reminders_per_second']}/s, {source})")
+
 # Function to send automatic reminders
 async def send_automatic_reminders():
     """
-    Check for appointments and send reminders:
+    Sweep for reminders that are due but weren't sent by the reminder engine
+    (e.g. appointments confirmed by another worker):
     - 24 hours before appointment
     - 3 hours before appointment
     """
     try:
+        async with reminder_lock:
+            now = datetime.now(timezone.utc)
+            await run_reminder_windows(
+                [(window, reminder_window_query(window, now)) for window in REMINDER_WINDOWS], "sweep"
+            )
+    
+    except Exception as e:
+        print(f"❌ Error in automatic reminders: {e}")
+
+class ReminderEngine:
+    """
+    Fires appointment reminders at their exact due time.
+    
+    Due times live in a min-heap of (due_at, appointment_id, window_index,
+    generation) tuples. Reschedules and cancellations don't touch the heap:
+    every schedule() call gets a new generation, and entries from an older
+    generation are skipped when they are popped.
+    """
+    
+    def __init__(self):
+        self._heap = []
+        self._appointments = {}  # appointment_id -> [generation, pending reminders]
+        self._generations = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.fired_count = 0
+        self.last_lag_seconds = 0.0
+        self.max_lag_seconds = 0.0
+        self.total_lag_seconds = 0.0
+        self.last_rebuild_at = None
+    
+    def schedule(self, appointment: dict):
+        """(Re)schedule an appointment's reminders; non-confirmed appointments are dropped"""
+        appointment_id = appointment['id']
+        if appointment.get('status') != AppointmentStatus.CONFIRMED:
+            self.cancel(appointment_id)
+            return
+        
+        apt_date = appointment['appointment_date']
+        if apt_date.tzinfo is None:
+            apt_date = apt_date.replace(tzinfo=timezone.utc)
         now = datetime.now(timezone.utc)
         
-        # Get all confirmed appointments
-        appointments = await db.appointments.find({"status": "confirmed"}, {"_id": 0}).to_list(1000)
+        generation = next(self._generations)
+        pending = 0
+        for window_index, window in enumerate(REMINDER_WINDOWS):
+            if appointment.get(window["flag"]):
+                continue
+            # Past the catch-up tolerance: the text would no longer be true
+            if apt_date - timedelta(hours=window["start_hours"]) <= now:
+                continue
+            due_at = apt_date - timedelta(hours=window["end_hours"])
+            if not self._heap or due_at < self._heap[0][0]:
+                self._wakeup.set()
+            heapq.heappush(self._heap, (due_at, appointment_id, window_index, generation))
+            pending += 1
         
-        for apt in appointments:
-            # Parse appointment date
-            apt_date = datetime.fromisoformat(apt['appointment_date']) if isinstance(apt['appointment_date'], str) else apt['appointment_date']
-            
-            # Make sure apt_date is timezone-aware
-            if apt_date.tzinfo is None:
-                apt_date = apt_date.replace(tzinfo=timezone.utc)
+        if pending:
+            self._appointments[appointment_id] = [generation, pending]
+        else:
+            self._appointments.pop(appointment_id, None)
+        self._compact()
+    
+    def cancel(self, appointment_id: str):
+        """Drop an appointment's pending reminders"""
+        self._appointments.pop(appointment_id, None)
+        self._compact()
+    
+    def _compact(self):
+        # Rebuild the heap once stale entries outnumber live ones
+        if len(self._heap) > 64 and len(self._heap) > 4 * len(self._appointments):
+            self._heap = [entry for entry in self._heap if self._is_live(entry)]
+            heapq.heapify(self._heap)
+    
+    def _is_live(self, entry: tuple) -> bool:
+        state = self._appointments.get(entry[1])
+        return state is not None and state[0] == entry[3]
+    
+    async def rebuild(self):
+        """Reload every upcoming reminder from MongoDB; overdue ones fire immediately"""
+        self._heap = []
+        self._appointments = {}
+        query = {
+            "status": "confirmed",
+            "appointment_date": {"$gt": datetime.now(timezone.utc)},
+            "$or": [{window["flag"]: {"$ne": True}} for window in REMINDER_WINDOWS]
+        }
+        projection = {"_id": 0, "id": 1, "status": 1, "appointment_date": 1}
+        for window in REMINDER_WINDOWS:
+            projection[window["flag"]] = 1
+        
+        async for apt in db.appointments.find(query, projection).batch_size(REMINDER_BATCH_SIZE):
+            self.schedule(apt)
+        self.last_rebuild_at = datetime.now(timezone.utc)
+        self._wakeup.set()
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            if self._heap:
+                timeout = max(0.0, (self._heap[0][0] - datetime.now(timezone.utc)).total_seconds())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
             
-            time_until_appointment = apt_date - now
-            hours_until = time_until_appointment.total_seconds() / 3600
+            try:
+                await self._fire_due()
+            except Exception as e:
+                print(f"❌ Error in reminder engine: {e}")
+    
+    async def _fire_due(self):
+        now = datetime.now(timezone.utc)
+        due = {}  # window_index -> [appointment_id]
+        latest_due_at = now
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if not self._is_live(entry):
+                continue
+            due_at, appointment_id, window_index, _ = entry
+            due.setdefault(window_index, []).append(appointment_id)
+            latest_due_at = max(latest_due_at, due_at)
             
-            # 24-hour reminder (send if between 24h and 23h before appointment)
-            if 23 <= hours_until <= 24 and not apt.get('reminder_24h_sent', False):
-                await send_reminder_notification(
-                    apt, 
-                    "تذكير: موعدك غداً 📅",
-                    f"موعدك مع د. {apt['doctor_name']} غداً في تمام الساعة {apt_date.strftime('%I:%M %p')}\n\nنتطلع لرؤيتك 🦷"
-                )
-                # Mark as sent
-                await db.appointments.update_one(
-                    {"id": apt['id']},
-                    {"$set": {"reminder_24h_sent": True}}
-                )
-                print(f"✅ Sent 24h reminder for appointment {apt['id']}")
+            # Forget the appointment once its last reminder has fired
+            state = self._appointments[appointment_id]
+            state[1] -= 1
+            if state[1] == 0:
+                del self._appointments[appointment_id]
             
-            # 3-hour reminder (send if between 3h and 2.5h before appointment)
-            elif 2.5 <= hours_until <= 3 and not apt.get('reminder_3h_sent', False):
-                await send_reminder_notification(
-                    apt,
-                    "تذكير: موعدك بعد 3 ساعات ⏰",
-                    f"موعدك مع د. {apt['doctor_name']} بعد 3 ساعات\n📍 عيادات الغصاب\n⏰ {apt_date.strftime('%I:%M %p')}\n\nنراك قريباً 😊"
-                )
-                # Mark as sent
-                await db.appointments.update_one(
-                    {"id": apt['id']},
-                    {"$set": {"reminder_3h_sent": True}}
-                )
-                print(f"✅ Sent 3h reminder for appointment {apt['id']}")
+            lag = (now - due_at).total_seconds()
+            self.fired_count += 1
+            self.last_lag_seconds = lag
+            self.max_lag_seconds = max(self.max_lag_seconds, lag)
+            self.total_lag_seconds += lag
+        
+        queries = []
+        for window_index, appointment_ids in due.items():
+            window = REMINDER_WINDOWS[window_index]
+            # Re-check status, date and flag in the same query
+            query = reminder_window_query(window, latest_due_at)
+            query["id"] = {"$in": appointment_ids}
+            queries.append((window, query))
+        
+        if queries:
+            async with reminder_lock:
+                await run_reminder_windows(queries, "engine")
     
-    except Exception as e:
-        print(f"❌ Error in automatic reminders: {e}")
+    def metrics(self) -> dict:
+        now = datetime.now(timezone.utc)
+        while self._heap and not self._is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+        next_due_at = self._heap[0][0] if self._heap else None
+        return {
+            "queue_depth": len(self._appointments),
+            "heap_size": len(self._heap),
+            "next_due_at": next_due_at,
+            "overdue_seconds": max(0.0, (now - next_due_at).total_seconds()) if next_due_at else 0.0,
+            "fired_count": self.fired_count,
+            "last_lag_seconds": round(self.last_lag_seconds, 3),
+            "max_lag_seconds": round(self.max_lag_seconds, 3),
+            "avg_lag_seconds": round(self.total_lag_seconds / self.fired_count, 3) if self.fired_count else 0.0,
+            "last_rebuild_at": self.last_rebuild_at,
+            "running": self._task is not None and not self._task.done()
+        }
 
-async def send_reminder_notification(appointment: dict, title: str, message: str):
-    """Send reminder notification via OneSignal"""
-    try:
-        async with httpx.AsyncClient() as client:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Basic {ONESIGNAL_REST_API_KEY}"
-            }
+reminder_engine = ReminderEngine()
+
+# Date fields of each collection. They are stored as native BSON dates;
+# releases before that wrote ISO strings, which migrate_iso_dates() rewrites.
+DATE_FIELDS = {
+    "users": ["created_at"],
+    "admin_users": ["created_at"],
+    "otps": ["expires_at", "created_at"],
+    "doctors": ["created_at"],
+    "services": ["created_at"],
+    "appointments": ["appointment_date", "created_at"],
+    "campaigns": ["created_at", "scheduled_for", "last_sent_at"],
+    "notifications": ["created_at"],
+    "reviews": ["created_at"],
+}
+MIGRATION_BATCH_SIZE = 1000
+ISO_DATES_MIGRATION = "iso_dates"
+
+def to_document(model: BaseModel) -> dict:
+    """
+    Storage codec: a model as the document we persist
+    Datetimes stay datetime objects and are written as BSON dates; the client is
+    tz_aware, so reads hand them back as aware UTC datetimes the models accept as-is.
+    """
+    return model.model_dump()
+
+def parse_stored_date(value: str) -> datetime:
+    """Parse a legacy ISO-string date, treating naive values as UTC"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+async def migrate_iso_dates(batch_size: int = MIGRATION_BATCH_SIZE) -> dict:
+    """
+    Rewrite ISO-string dates in DATE_FIELDS as native BSON dates, in _id order
+    Progress is checkpointed in the migrations collection after every batch, so an
+    interrupted run resumes where it stopped and a finished one is a no-op.
+    Returns the number of documents converted per collection.
+    """
+    state = await db.migrations.find_one({"_id": ISO_DATES_MIGRATION}) or {}
+    if state.get("completed_at"):
+        return {}
+    
+    converted = {}
+    for collection_name, fields in DATE_FIELDS.items():
+        progress = state.get("collections", {}).get(collection_name, {})
+        if progress.get("done"):
+            continue
+        
+        collection = db[collection_name]
+        last_id = progress.get("last_id")
+        count = 0
+        while True:
+            query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = await collection.find(query, {field: 1 for field in fields}).sort("_id", ASCENDING).to_list(batch_size)
+            if not batch:
+                break
             
-            payload = {
-                "app_id": ONESIGNAL_APP_ID,
-                "included_segments": ["All"],
-                "headings": {"en": title, "ar": title},
-                "contents": {"en": message, "ar": message},
-                "url": "https://dental-booking-16.preview.emergentagent.com/patient/dashboard"
-            }
+            updates = []
+            for doc in batch:
+                dates = {}
+                for field in fields:
+                    if not isinstance(doc.get(field), str):
+                        continue
+                    try:
+                        dates[field] = parse_stored_date(doc[field])
+                    except ValueError:
+                        print(f"⚠️ {collection_name} {doc['_id']}: unparseable {field} {doc[field]!r}, set to null")
+                        dates[field] = None
+                updates.append(UpdateOne({"_id": doc['_id']}, {"$set": dates}))
+            await collection.bulk_write(updates, ordered=False)
             
-            response = await client.post(
-                "https://onesignal.com/api/v1/notifications",
-                headers=headers,
-                json=payload,
-                timeout=10.0
+            last_id = batch[-1]['_id']
+            count += len(updates)
+            await db.migrations.update_one(
+                {"_id": ISO_DATES_MIGRATION},
+                {"$set": {f"collections.{collection_name}.last_id": last_id},
+                 "$inc": {f"collections.{collection_name}.converted": len(updates)}},
+                upsert=True
             )
-            
-            if response.status_code == 200:
-                print(f"✅ Reminder notification sent for {appointment.get('patient_phone', 'unknown')}")
-            else:
-                print(f"❌ Failed to send reminder: {response.text}")
-    except Exception as e:
-        print(f"❌ Error sending reminder notification: {e}")
+        
+        await db.migrations.update_one(
+            {"_id": ISO_DATES_MIGRATION},
+            {"$set": {f"collections.{collection_name}.done": True}},
+            upsert=True
+        )
+        converted[collection_name] = count
+    
+    await db.migrations.update_one(
+        {"_id": ISO_DATES_MIGRATION},
+        {"$set": {"completed_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return converted
 
 # Enums
 class UserRole(str, Enum):
@@ -157,7 +871,7 @@ class User(BaseModel):
     phone: str
     name: Optional[str] = None
     role: UserRole = UserRole.PATIENT
-    fcm_token: Optional[str] = None
+    fcm_token: Optional[str] = None  # OneSignal player id of the latest device
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class UserCreate(BaseModel):
@@ -175,6 +889,7 @@ class Doctor(BaseModel):
     specialization: str
     phone: Optional[str] = None
     available_days: List[str] = []
+    version: int = 0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class DoctorCreate(BaseModel):
@@ -183,6 +898,13 @@ class DoctorCreate(BaseModel):
     phone: Optional[str] = None
     available_days: List[str] = []
 
+class DoctorUpdate(BaseModel):
+    name: Optional[str] = None
+    specialization: Optional[str] = None
+    phone: Optional[str] = None
+    available_days: Optional[List[str]] = None
+    version: Optional[int] = None  # version the edit is based on; omit to overwrite
+
 class Service(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -191,6 +913,7 @@ class Service(BaseModel):
     description: Optional[str] = None
     duration_minutes: int = 30
     price: Optional[float] = None
+    version: int = 0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class ServiceCreate(BaseModel):
@@ -200,6 +923,14 @@ class ServiceCreate(BaseModel):
     duration_minutes: int = 30
     price: Optional[float] = None
 
+class ServiceUpdate(BaseModel):
+    name: Optional[str] = None
+    name_en: Optional[str] = None
+    description: Optional[str] = None
+    duration_minutes: Optional[int] = None
+    price: Optional[float] = None
+    version: Optional[int] = None  # version the edit is based on; omit to overwrite
+
 class Appointment(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -216,6 +947,7 @@ class Appointment(BaseModel):
     reminder_24h_sent: bool = False
     reminder_3h_sent: bool = False
     post_visit_sent: bool = False
+    version: int = 0  # bumped by every edit, see versioned_update()
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_by: str = "patient"  # patient or admin
 
@@ -235,6 +967,22 @@ class AppointmentUpdate(BaseModel):
     appointment_date: Optional[datetime] = None
     status: Optional[AppointmentStatus] = None
     notes: Optional[str] = None
+    version: Optional[int] = None  # version the edit is based on; omit to overwrite
+
+class BulkAppointmentOperation(BaseModel):
+    """One item of a bulk request: create, or update the appointment with appointment_id"""
+    appointment_id: Optional[str] = None
+    create: Optional[AppointmentCreate] = None
+    update: Optional[AppointmentUpdate] = None
+
+class BulkAppointmentRequest(BaseModel):
+    operations: List[BulkAppointmentOperation]
+
+class BulkAppointmentResult(BaseModel):
+    index: int
+    status_code: int
+    appointment: Optional[Appointment] = None
+    detail: Optional[str] = None
 
 class Campaign(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -248,6 +996,8 @@ class Campaign(BaseModel):
     booked_count: int = 0
     status: str = "draft"  # draft, sent, scheduled
     scheduled_for: Optional[datetime] = None
+    broadcast_at: Optional[datetime] = None  # first sent; shown in patients' feeds from then
+    version: int = 0
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_by: str
 
@@ -258,6 +1008,21 @@ class CampaignCreate(BaseModel):
     target_filter: Optional[dict] = None
     scheduled_for: Optional[datetime] = None
 
+class CampaignUpdate(BaseModel):
+    title: Optional[str] = None
+    message: Optional[str] = None
+    target_audience: Optional[str] = None
+    target_filter: Optional[dict] = None
+    scheduled_for: Optional[datetime] = None
+    version: Optional[int] = None  # version the edit is based on; omit to overwrite
+
+class CampaignDelivery(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    campaign_id: str
+    phone: str
+    user_id: Optional[str] = None
+    sent_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
 class Notification(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -276,6 +1041,12 @@ class NotificationCreate(BaseModel):
     type: str
     appointment_id: Optional[str] = None
 
+class NotificationsRead(BaseModel):
+    """Mark the given notifications, or all up to before (inclusive), or all, as read"""
+    user_id: str
+    ids: Optional[List[str]] = None
+    before: Optional[datetime] = None
+
 class Review(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -291,6 +1062,21 @@ class ReviewCreate(BaseModel):
     rating: int
     comment: Optional[str] = None
 
+class OutboxMessage(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    kind: str  # reminder, confirmation, campaign, device
+    reference: Optional[str] = None  # appointment, campaign or user id
+    payload: dict
+    url: Optional[str] = None  # defaults to the notifications endpoint
+    method: str = "POST"
+    status: str = "pending"  # pending, in_flight, sent, dead
+    attempts: int = 0
+    next_attempt_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    last_error: Optional[str] = None
+    sent_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
 class Stats(BaseModel):
     total_appointments: int
     pending_appointments: int
@@ -300,6 +1086,17 @@ class Stats(BaseModel):
     total_patients: int
     total_doctors: int
     avg_rating: float
+    updated_at: Optional[datetime] = None  # when the counters were last changed
+
+class AvailabilityDay(BaseModel):
+    date: date
+    slots: List[datetime]  # free start times (UTC)
+
+class DoctorAvailability(BaseModel):
+    doctor_id: str
+    doctor_name: str
+    duration_minutes: int
+    days: List[AvailabilityDay]
 
 # Helper functions
 def create_access_token(data: dict):
@@ -309,9 +1106,155 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Authentication: a token is verified once, then its claims and user document are
+# served from a bounded TTL cache keyed by the token's hash. The router verifies any
+# bearer token it is sent; routes that need a caller depend on require_user/require_admin.
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", "60"))
+auth_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+async def verify_token(token: str) -> dict:
+    """
+    Verify a JWT and load its user
+    Returns {"key", "claims", "user"}; the user comes from admin_users for admin tokens.
+    """
+    key = hashlib.sha256(token.encode()).hexdigest()
+    auth = auth_cache.get(key)
+    if auth and auth["claims"].get("exp", 0) > time.time():
+        return auth
+    
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    users = db.admin_users if claims.get("role") == UserRole.ADMIN else db.users
+    user = await users.find_one({"id": claims.get("user_id")}, {"_id": 0, "password_hash": 0})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    auth = {"key": key, "claims": claims, "user": user}
+    auth_cache[key] = auth
+    return auth
+
+async def authenticate(request: Request):
+    """Router-wide dependency: verify the bearer token if one is sent"""
+    request.state.auth = None
+    request.state.auth_error = None
+    authorization = request.headers.get("authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        try:
+            request.state.auth = await verify_token(authorization[7:].strip())
+        except HTTPException as e:
+            # Only routes that need a caller reject a bad token
+            request.state.auth_error = e
+
+async def require_user(request: Request, token: Optional[str] = None) -> dict:
+    """The authenticated caller; token is the legacy query-parameter form"""
+    auth = getattr(request.state, "auth", None)
+    if auth is None and token:
+        auth = await verify_token(token)
+    if auth is None:
+        raise getattr(request.state, "auth_error", None) or HTTPException(status_code=401, detail="Not authenticated")
+    return auth
+
+async def require_admin(auth: dict = Depends(require_user)) -> dict:
+    if auth["claims"].get("role") != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return auth
+
 def generate_otp():
     return str(random.randint(100000, 999999))
 
+# OTP store. Issuing is one upsert that replaces the phone's previous OTP, and a
+# correct code is consumed by one find_one_and_delete that also checks expiry and
+# the attempt count. OTP_STORE=memory keeps them in process instead, for
+# single-node deployments only (every worker would have its own store).
+OTP_STORE = os.environ.get("OTP_STORE", "mongo")
+OTP_TTL_MINUTES = int(os.environ.get("OTP_TTL_MINUTES", "5"))
+OTP_MAX_ATTEMPTS = int(os.environ.get("OTP_MAX_ATTEMPTS", "5"))
+
+class OTPStatus(str, Enum):
+    VALID = "valid"
+    INVALID = "invalid"
+    EXPIRED = "expired"
+    LOCKED = "locked"  # too many wrong codes; a new OTP must be requested
+
+class MongoOTPStore:
+    """OTPs in the otps collection, removed by its expires_at TTL index"""
+    
+    async def issue(self, phone: str, otp: str):
+        now = datetime.now(timezone.utc)
+        await db.otps.update_one(
+            {"phone": phone},
+            {"$set": {
+                "otp": otp,
+                "attempts": 0,
+                "expires_at": now + timedelta(minutes=OTP_TTL_MINUTES),
+                "created_at": now
+            }},
+            upsert=True
+        )
+    
+    async def consume(self, phone: str, otp: str) -> OTPStatus:
+        now = datetime.now(timezone.utc)
+        used = await db.otps.find_one_and_delete({
+            "phone": phone,
+            "otp": otp,
+            "expires_at": {"$gt": now},
+            "attempts": {"$not": {"$gte": OTP_MAX_ATTEMPTS}}
+        }, projection={"_id": 1})
+        if used:
+            return OTPStatus.VALID
+        
+        # Wrong, expired or locked: count the attempt and report which
+        record = await db.otps.find_one_and_update(
+            {"phone": phone},
+            {"$inc": {"attempts": 1}},
+            projection={"_id": 0, "expires_at": 1, "attempts": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not record:
+            return OTPStatus.INVALID
+        if record['expires_at'] <= now:
+            return OTPStatus.EXPIRED
+        if record['attempts'] > OTP_MAX_ATTEMPTS:
+            return OTPStatus.LOCKED
+        return OTPStatus.INVALID
+
+class MemoryOTPStore:
+    """OTPs in a dict of phone -> [otp, expires_at, attempts]"""
+    
+    def __init__(self):
+        self._otps = {}
+        self._purge_at = 1000
+    
+    async def issue(self, phone: str, otp: str):
+        now = datetime.now(timezone.utc)
+        self._otps[phone] = [otp, now + timedelta(minutes=OTP_TTL_MINUTES), 0]
+        if len(self._otps) >= self._purge_at:
+            self._otps = {key: value for key, value in self._otps.items() if value[1] > now}
+            self._purge_at = max(1000, 2 * len(self._otps))
+    
+    async def consume(self, phone: str, otp: str) -> OTPStatus:
+        record = self._otps.get(phone)
+        if not record:
+            return OTPStatus.INVALID
+        if record[1] <= datetime.now(timezone.utc):
+            del self._otps[phone]
+            return OTPStatus.EXPIRED
+        if record[2] >= OTP_MAX_ATTEMPTS:
+            return OTPStatus.LOCKED
+        if record[0] != otp:
+            record[2] += 1
+            return OTPStatus.LOCKED if record[2] > OTP_MAX_ATTEMPTS else OTPStatus.INVALID
+        del self._otps[phone]
+        return OTPStatus.VALID
+
+otp_store = MemoryOTPStore() if OTP_STORE == "memory" else MongoOTPStore()
+
 async def send_notification(user_id: str, title: str, message: str, notification_type: str, appointment_id: Optional[str] = None):
     """Send notification to user and store in database"""
     notification = Notification(
@@ -321,13 +1264,973 @@ async def send_notification(user_id: str, title: str, message: str, notification
         type=notification_type,
         appointment_id=appointment_id
     )
-    doc = notification.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
+    doc = to_document(notification)
     await db.notifications.insert_one(doc)
+    await bump_unread({user_id: 1})
     
     # Note: Push notifications sent via campaigns endpoint
     return notification
 
+# Unread counters: one notification_counters document per user (_id = user id)
+# kept current with $inc, so the app badge is a primary-key read. Only unread ->
+# read transitions that actually happened (modified_count) decrement it.
+NOTIFICATION_COUNTERS_BACKFILL = "notification_counters_backfill"
+
+async def bump_unread(counts: dict):
+    """Add to the unread counters of several users ({user_id: delta}) in one round trip"""
+    updates = [
+        UpdateOne({"_id": user_id}, {"$inc": {"unread": delta}}, upsert=True)
+        for user_id, delta in counts.items() if delta
+    ]
+    if updates:
+        await db.notification_counters.bulk_write(updates, ordered=False)
+
+def inbox_unread(inbox: Optional[dict], broadcasts: List[dict], user_id: str) -> int:
+    """Unread personal notifications (the counter) plus unread broadcasts"""
+    unread = max(inbox.get("unread", 0), 0) if inbox else 0
+    return unread + sum(not notification['read'] for notification in user_broadcasts(broadcasts, inbox, user_id))
+
+async def count_unread(user_id: str) -> int:
+    """Recount a user's unread notifications and reset the counter to it"""
+    unread = await db.notifications.count_documents({"user_id": user_id, "read": {"$ne": True}})
+    await db.notification_counters.update_one({"_id": user_id}, {"$set": {"unread": unread}}, upsert=True)
+    return unread
+
+async def backfill_notification_counters() -> int:
+    """Set the counters from the notifications sent before they existed (once)"""
+    if await db.migrations.find_one({"_id": NOTIFICATION_COUNTERS_BACKFILL}):
+        return 0
+    
+    updates = []
+    async for row in db.notifications.aggregate([
+        {"$match": {"read": {"$ne": True}}},
+        {"$group": {"_id": "$user_id", "unread": {"$sum": 1}}}
+    ]):
+        updates.append(UpdateOne({"_id": row["_id"]}, {"$set": {"unread": row["unread"]}}, upsert=True))
+    if updates:
+        await db.notification_counters.bulk_write(updates, ordered=False)
+    
+    await db.migrations.insert_one({"_id": NOTIFICATION_COUNTERS_BACKFILL, "completed_at": datetime.now(timezone.utc)})
+    return len(updates)
+
+# Campaign broadcasts (fan-out on read): a sent campaign is stored once, on the
+# campaign itself (broadcast_at), and merged into every patient's notification
+# feed when it is read, so sending one costs O(1) writes instead of one
+# notification per user. Per-user state is sparse and lives on the user's
+# notification_counters document: joined_at (older broadcasts are not shown),
+# and the ids of broadcasts read or dismissed.
+BROADCAST_CACHE_SECONDS = float(os.environ.get("BROADCAST_CACHE_SECONDS", "30"))
+broadcast_cache = TTLCache(maxsize=1, ttl=BROADCAST_CACHE_SECONDS)
+
+async def campaign_broadcasts() -> List[dict]:
+    """Broadcast campaigns, newest first; cached briefly since they change a few times a month"""
+    broadcasts = broadcast_cache.get("all")
+    if broadcasts is None:
+        broadcasts = await db.campaigns.find(
+            {"broadcast_at": {"$ne": None}},
+            {"_id": 0, "id": 1, "title": 1, "message": 1, "broadcast_at": 1}
+        ).sort([("broadcast_at", DESCENDING), ("id", DESCENDING)]).to_list(None)
+        broadcast_cache["all"] = broadcasts
+    return broadcasts
+
+def user_broadcasts(broadcasts: List[dict], inbox: Optional[dict], user_id: str) -> List[dict]:
+    """The broadcasts a user sees, shaped as their notifications (newest first)"""
+    inbox = inbox or {}
+    joined_at = inbox.get("joined_at")
+    read = set(inbox.get("broadcasts_read", []))
+    dismissed = set(inbox.get("broadcasts_dismissed", []))
+    return [
+        {
+            "id": broadcast['id'],
+            "user_id": user_id,
+            "title": broadcast['title'],
+            "message": broadcast['message'],
+            "type": "campaign",
+            "appointment_id": None,
+            "read": broadcast['id'] in read,
+            "created_at": broadcast['broadcast_at'],
+        }
+        for broadcast in broadcasts
+        if broadcast['id'] not in dismissed and (joined_at is None or broadcast['broadcast_at'] >= joined_at)
+    ]
+
+async def notify_confirmed(appointments: List[dict]):
+    """In-app notification and push for confirmed appointments, one insert of each for the batch"""
+    appointments = [apt for apt in appointments if apt.get('patient_phone')]
+    if not appointments:
+        return
+    
+    # In-app notification only for appointments booked by a patient account
+    notifications = [
+        Notification(
+            user_id=apt['patient_id'],
+            title="تم تأكيد موعدك",
+            message=f"تم تأكيد موعدك مع د. {apt['doctor_name']} في {apt['appointment_date']}",
+            type="reminder",
+            appointment_id=apt['id']
+        )
+        for apt in appointments if apt.get('patient_id')
+    ]
+    if notifications:
+        await db.notifications.insert_many([to_document(notification) for notification in notifications])
+        counts = {}
+        for notification in notifications:
+            counts[notification.user_id] = counts.get(notification.user_id, 0) + 1
+        await bump_unread(counts)
+    
+    # Push to the patient's own devices via OneSignal
+    user_ids = await resolve_patient_user_ids(appointments)
+    messages = []
+    for apt in appointments:
+        if apt['id'] not in user_ids:
+            print(f"⚠️ No registered user for phone {apt['patient_phone']}, skipping push")
+            continue
+        formatted_date = apt['appointment_date'].strftime('%A %d %B الساعة %I:%M %p')
+        payloads = build_push_payloads(
+            "✅ تم تأكيد موعدك",
+            f"موعدك مع د. {apt['doctor_name']}\n{formatted_date}\n\nنتطلع لرؤيتك 🦷",
+            [user_ids[apt['id']]]
+        )
+        messages.append(OutboxMessage(kind="confirmation", reference=apt['id'], payload=payloads[0]))
+    await enqueue_messages(messages)
+
+# Stats helpers: the dashboard reads one materialized document that writes keep
+# current with $inc; rebuild_stats() recomputes it from scratch in one pipeline
+STATS_ID = "dashboard"
+
+async def compute_stats() -> dict:
+    """Count appointments by status, patients, doctors and ratings in one aggregation"""
+    pipeline = [
+        {"$project": {"_id": 0, "kind": {"$literal": "appointment"}, "status": 1}},
+        {"$unionWith": {"coll": "users", "pipeline": [
+            {"$match": {"role": "patient"}},
+            {"$project": {"_id": 0, "kind": {"$literal": "patient"}}}
+        ]}},
+        {"$unionWith": {"coll": "doctors", "pipeline": [
+            {"$project": {"_id": 0, "kind": {"$literal": "doctor"}}}
+        ]}},
+        {"$unionWith": {"coll": "reviews", "pipeline": [
+            {"$project": {"_id": 0, "kind": {"$literal": "review"}, "rating": 1}}
+        ]}},
+        {"$group": {
+            "_id": {"kind": "$kind", "status": "$status"},
+            "count": {"$sum": 1},
+            "rating_sum": {"$sum": "$rating"}
+        }}
+    ]
+    
+    stats = {
+        "total_appointments": 0,
+        "pending_appointments": 0,
+        "confirmed_appointments": 0,
+        "completed_appointments": 0,
+        "cancelled_appointments": 0,
+        "total_patients": 0,
+        "total_doctors": 0,
+        "rating_sum": 0,
+        "rating_count": 0
+    }
+    async for row in db.appointments.aggregate(pipeline):
+        kind = row["_id"]["kind"]
+        if kind == "appointment":
+            stats["total_appointments"] += row["count"]
+            status_field = f"{row['_id'].get('status')}_appointments"
+            if status_field in stats:
+                stats[status_field] += row["count"]
+        elif kind == "patient":
+            stats["total_patients"] = row["count"]
+        elif kind == "doctor":
+            stats["total_doctors"] = row["count"]
+        elif kind == "review":
+            stats["rating_sum"] = row["rating_sum"]
+            stats["rating_count"] = row["count"]
+    return stats
+
+async def rebuild_stats() -> dict:
+    """Recompute the materialized stats document"""
+    stats = await compute_stats()
+    stats["updated_at"] = datetime.now(timezone.utc)
+    await db.stats.replace_one({"_id": STATS_ID}, stats, upsert=True)
+    return stats
+
+async def bump_stats(deltas: dict):
+    """Apply counter deltas to the materialized stats document"""
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    # No upsert: a missing document is rebuilt in full on the next read
+    await db.stats.update_one(
+        {"_id": STATS_ID},
+        {"$inc": deltas, "$set": {"updated_at": datetime.now(timezone.utc)}}
+    )
+
+def appointment_status_deltas(old_status: Optional[str], new_status: Optional[str]) -> dict:
+    """Stats deltas for an appointment moving from old_status to new_status (None = absent)"""
+    deltas = {"total_appointments": (new_status is not None) - (old_status is not None)}
+    # Statuses arrive as enum members from models and as plain strings from MongoDB
+    old_status = old_status and AppointmentStatus(old_status).value
+    new_status = new_status and AppointmentStatus(new_status).value
+    if old_status != new_status:
+        if old_status:
+            deltas[f"{old_status}_appointments"] = -1
+        if new_status:
+            deltas[f"{new_status}_appointments"] = 1
+    return deltas
+
+# Optimistic concurrency: editable documents carry a version that every edit
+# increments. An edit sent with the version it was based on is a single
+# find_one_and_update conditioned on that version, so of two admins saving the
+# same document the second gets a 409 instead of silently overwriting the first.
+VERSION_CONFLICT_DETAIL = "تم تعديل هذا السجل من قبل مستخدم آخر، يرجى تحديث الصفحة والمحاولة مرة أخرى"
+
+def versioned_filter(doc_id: str, version: Optional[int]) -> dict:
+    """Filter matching the document only at the given version (any version if None)"""
+    query = {"id": doc_id}
+    if version is not None:
+        # Documents written before versioning have no field and count as version 0
+        query["version"] = version if version else {"$in": [0, None]}
+    return query
+
+async def versioned_update(collection, label: str, doc_id: str, version: Optional[int], update_data: dict,
+                           return_document: ReturnDocument = ReturnDocument.AFTER) -> dict:
+    """
+    $set update_data and bump the version in one round trip
+    Raises 404 if the document doesn't exist and 409 if it is no longer at version.
+    """
+    if not update_data:
+        return await versioned_find(collection, label, doc_id, version)
+    doc = await collection.find_one_and_update(
+        versioned_filter(doc_id, version),
+        {"$set": update_data, "$inc": {"version": 1}},
+        projection={"_id": 0},
+        return_document=return_document
+    )
+    if doc is None:
+        raise await version_miss(collection, label, doc_id, version)
+    return doc
+
+async def versioned_find(collection, label: str, doc_id: str, version: Optional[int]) -> dict:
+    """Read the document at version (any version if None); 404/409 as in versioned_update"""
+    doc = await collection.find_one(versioned_filter(doc_id, version), {"_id": 0})
+    if doc is None:
+        raise await version_miss(collection, label, doc_id, version)
+    return doc
+
+async def version_miss(collection, label: str, doc_id: str, version: Optional[int]) -> HTTPException:
+    """The error for a versioned read or write that matched nothing"""
+    if version is None or not await collection.find_one({"id": doc_id}, {"_id": 1}):
+        return HTTPException(status_code=404, detail=f"{label} not found")
+    return HTTPException(status_code=409, detail=VERSION_CONFLICT_DETAIL)
+
+# Keyset pagination: list routes sort on (sort_field, id), both covered by an
+# index, and return an opaque cursor for the next page in the X-Next-Cursor header.
+# The cursor holds the last row's sort key, so every page is one index seek.
+PAGE_SIZE_MAX = 1000
+CURSOR_HEADER = "X-Next-Cursor"
+CURSOR_JSON_OPTIONS = json_util.JSONOptions(tz_aware=True, tzinfo=timezone.utc)
+
+def encode_cursor(doc: dict, sort_field: str) -> str:
+    """Opaque continuation token pointing just after doc"""
+    raw = json_util.dumps([doc.get(sort_field), doc["id"]], json_options=CURSOR_JSON_OPTIONS)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(token: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        sort_value, last_id = json_util.loads(raw, json_options=CURSOR_JSON_OPTIONS)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+    return sort_value, last_id
+
+async def find_page(collection, query: dict, sort_field: str, direction: int, limit: int, after: Optional[str], response: Response, projection: Optional[dict] = None) -> List[dict]:
+    """
+    Fetch one page of collection ordered by (sort_field, id) in direction
+    after: Cursor from the previous page's X-Next-Cursor header
+    Sets X-Next-Cursor on response when more rows follow.
+    """
+    if after:
+        sort_value, last_id = decode_cursor(after)
+        op = "$gt" if direction == ASCENDING else "$lt"
+        query = {"$and": [query, {"$or": [
+            {sort_field: {op: sort_value}},
+            {sort_field: sort_value, "id": {op: last_id}}
+        ]}]}
+    
+    # One extra row tells us whether there is a next page
+    docs = await collection.find(query, projection or {"_id": 0}).sort(
+        [(sort_field, direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        response.headers[CURSOR_HEADER] = encode_cursor(docs[-1], sort_field)
+    return docs
+
+# Fast list responses. Rows read back from our own collections were written from
+# these models, so with FAST_RESPONSES they are trusted: fields the stored document
+# lacks are filled from defaults computed once at import, and the rows go straight
+# to orjson instead of FastAPI validating and re-encoding each one against the
+# response_model. The JSON is the same apart from key order.
+#
+# The list routes also negotiate the wire format: a client sending
+# Accept: application/msgpack (the mobile apps on cellular links) gets the same
+# rows as MessagePack, with datetimes as msgpack Timestamp extension values.
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+def model_row_defaults(model) -> dict:
+    """Defaults of the model's optional fields, for documents written before they existed"""
+    return {
+        name: field.get_default(call_default_factory=True)
+        for name, field in model.model_fields.items()
+        if not field.is_required()
+    }
+
+LIST_ROW_DEFAULTS = {
+    model: model_row_defaults(model)
+    for model in (Doctor, Service, Appointment, Campaign, Notification, Review)
+}
+
+def model_projection(model) -> dict:
+    """Projection fetching only the fields the model exposes"""
+    return {"_id": 0, **{field: 1 for field in model.model_fields}}
+
+def wants_msgpack(request: Request) -> bool:
+    """Whether the client asked for MessagePack (JSON stays the default)"""
+    return MSGPACK_MEDIA_TYPE in request.headers.get("accept", "")
+
+def list_response(model, docs: List[dict], request: Request, response: Response):
+    """Return docs for a List[model] route in the negotiated format, through the fast path when enabled"""
+    response.headers["Vary"] = "Accept"
+    msgpack_body = wants_msgpack(request)
+    if not (FAST_RESPONSES or msgpack_body):
+        return docs
+    
+    defaults = LIST_ROW_DEFAULTS[model]
+    rows = [{**defaults, **doc} for doc in docs]
+    if msgpack_body:
+        fast_response = Response(content=msgpack.packb(rows, datetime=True), media_type=MSGPACK_MEDIA_TYPE)
+    else:
+        fast_response = Response(content=orjson.dumps(rows, option=orjson.OPT_UTC_Z), media_type="application/json")
+    fast_response.headers["Vary"] = "Accept"
+    # Returning a Response bypasses the injected one, so carry its cursor over
+    if CURSOR_HEADER in response.headers:
+        fast_response.headers[CURSOR_HEADER] = response.headers[CURSOR_HEADER]
+    return fast_response
+
+# Streaming exports: rows go from the Mongo cursor to the socket EXPORT_BATCH_SIZE
+# at a time, so memory stays bounded however many rows an export covers.
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+
+class ExportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+EXPORTS = {
+    "appointments": {"collection": "appointments", "filter": {}, "date_field": "appointment_date",
+                     "fields": list(Appointment.model_fields)},
+    "reviews": {"collection": "reviews", "filter": {}, "date_field": "created_at",
+                "fields": list(Review.model_fields)},
+    # Device tokens stay out of exports
+    "patients": {"collection": "users", "filter": {"role": UserRole.PATIENT}, "date_field": "created_at",
+                 "fields": ["id", "phone", "name", "created_at"]},
+}
+
+def csv_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    return str(value)
+
+def export_chunk(rows: List[dict], fields: List[str], export_format: ExportFormat) -> bytes:
+    if export_format == ExportFormat.NDJSON:
+        return b"".join(orjson.dumps(row, option=orjson.OPT_UTC_Z | orjson.OPT_APPEND_NEWLINE) for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([csv_value(row.get(field)) for field in fields] for row in rows)
+    return buffer.getvalue().encode()
+
+async def stream_export(spec: dict, query: dict, export_format: ExportFormat):
+    """Yield an export as bytes, one chunk per EXPORT_BATCH_SIZE rows"""
+    fields = spec["fields"]
+    cursor = db[spec["collection"]].find(
+        query, {"_id": 0, **{field: 1 for field in fields}}
+    ).sort([(spec["date_field"], ASCENDING), ("id", ASCENDING)]).batch_size(EXPORT_BATCH_SIZE)
+    
+    if export_format == ExportFormat.CSV:
+        # The header goes out before the first query returns; the BOM makes
+        # Excel read the Arabic names as UTF-8
+        buffer = io.StringIO()
+        buffer.write("\ufeff")
+        csv.writer(buffer).writerow(fields)
+        yield buffer.getvalue().encode()
+    
+    rows = []
+    try:
+        async for doc in cursor:
+            rows.append(doc)
+            if len(rows) >= EXPORT_BATCH_SIZE:
+                yield export_chunk(rows, fields, export_format)
+                rows = []
+        if rows:
+            yield export_chunk(rows, fields, export_format)
+    finally:
+        await cursor.close()
+
+# Catalog cache: doctors and services change a few times a year, so every worker
+# keeps both catalogs in memory and the booking path never reads them from MongoDB.
+# Writers bump a version stamp in the cache_versions collection; each worker polls
+# it and reloads when it moves, so other workers catch up within CATALOG_POLL_SECONDS.
+CATALOG_POLL_SECONDS = float(os.environ.get("CATALOG_POLL_SECONDS", "5"))
+CATALOG_VERSION_ID = "catalog"
+CATALOG_MODELS = {"doctors": Doctor, "services": Service}
+
+class CatalogCache:
+    """In-process copy of the doctors and services collections"""
+    
+    def __init__(self, poll_seconds: float):
+        self.poll_seconds = poll_seconds
+        self.version = None
+        self.loaded_at = None
+        self.reload_count = 0
+        self._by_id = {name: {} for name in CATALOG_MODELS}
+        self._ordered = {name: [] for name in CATALOG_MODELS}  # sorted by (created_at, id)
+        self._task = None
+    
+    async def _read_version(self) -> int:
+        stamp = await db.cache_versions.find_one({"_id": CATALOG_VERSION_ID})
+        return stamp["version"] if stamp else 0
+    
+    async def load(self):
+        """Reload both catalogs from MongoDB"""
+        # Read the stamp first: a write racing the load leaves us one version
+        # behind, so the next poll reloads again rather than missing it
+        version = await self._read_version()
+        for name, model in CATALOG_MODELS.items():
+            docs = await db[name].find({}, model_projection(model)).sort(
+                [("created_at", ASCENDING), ("id", ASCENDING)]
+            ).to_list(None)
+            self._ordered[name] = docs
+            self._by_id[name] = {doc['id']: doc for doc in docs}
+        self.version = version
+        self.loaded_at = datetime.now(timezone.utc)
+        self.reload_count += 1
+    
+    async def invalidate(self):
+        """Call after writing doctors or services: bump the shared stamp and reload this worker"""
+        await db.cache_versions.update_one({"_id": CATALOG_VERSION_ID}, {"$inc": {"version": 1}}, upsert=True)
+        await self.load()
+    
+    def all(self, name: str) -> List[dict]:
+        """Every doctor or service, ordered by (created_at, id)"""
+        return self._ordered[name]
+    
+    def cached(self, name: str, item_id: str) -> Optional[dict]:
+        """A doctor or service by id from memory only (None if not loaded yet)"""
+        return self._by_id[name].get(item_id)
+    
+    async def get(self, name: str, item_id: str) -> Optional[dict]:
+        """A doctor or service by id (treat as read-only)"""
+        doc = self._by_id[name].get(item_id)
+        if doc is None:
+            # Possibly added by another worker since our last poll
+            doc = await db[name].find_one({"id": item_id}, model_projection(CATALOG_MODELS[name]))
+        return doc
+    
+    def page(self, name: str, limit: int, after: Optional[str], response: Response) -> List[dict]:
+        """One keyset page of a catalog, with the same cursors as find_page"""
+        docs = self._ordered[name]
+        start = 0
+        if after:
+            start = bisect.bisect_right(docs, decode_cursor(after), key=lambda doc: (doc['created_at'], doc['id']))
+        page = docs[start:start + limit]
+        if start + limit < len(docs):
+            response.headers[CURSOR_HEADER] = encode_cursor(page[-1], "created_at")
+        return page
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            try:
+                if await self._read_version() != self.version:
+                    await self.load()
+            except Exception as e:
+                print(f"❌ Catalog cache refresh failed: {str(e)}")
+    
+    def metrics(self) -> dict:
+        return {
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "reload_count": self.reload_count,
+            "doctors": len(self._ordered["doctors"]),
+            "services": len(self._ordered["services"])
+        }
+
+catalog_cache = CatalogCache(CATALOG_POLL_SECONDS)
+
+# Availability: clinic hours are the two shifts patients pick from in the booking
+# form (morning 9-12, evening 4-8, clinic local time). Free slots start on a
+# SLOT_MINUTES grid inside a shift, on the doctor's available_days, and must not
+# overlap a booking. Bookings are held per doctor as intervals sorted by start.
+CLINIC_TIMEZONE = ZoneInfo(os.environ.get("CLINIC_TIMEZONE", "Asia/Riyadh"))
+CLINIC_SHIFTS = [(clock_time(9), clock_time(12)), (clock_time(16), clock_time(20))]
+SLOT_MINUTES = int(os.environ.get("SLOT_MINUTES", "15"))
+DEFAULT_DURATION_MINUTES = 30
+AVAILABILITY_MAX_DAYS = 62
+AVAILABILITY_REFRESH_SECONDS = float(os.environ.get("AVAILABILITY_REFRESH_SECONDS", "60"))
+
+# available_days may be stored in English or Arabic
+WEEKDAYS = {
+    "monday": 0, "mon": 0, "الاثنين": 0, "الإثنين": 0,
+    "tuesday": 1, "tue": 1, "الثلاثاء": 1,
+    "wednesday": 2, "wed": 2, "الأربعاء": 2, "الاربعاء": 2,
+    "thursday": 3, "thu": 3, "الخميس": 3,
+    "friday": 4, "fri": 4, "الجمعة": 4,
+    "saturday": 5, "sat": 5, "السبت": 5,
+    "sunday": 6, "sun": 6, "الأحد": 6, "الاحد": 6,
+}
+
+def doctor_weekdays(doctor: dict) -> set:
+    """Weekday numbers the doctor works; an empty available_days means every day"""
+    days = {WEEKDAYS[day.strip().lower()] for day in doctor.get('available_days') or [] if day.strip().lower() in WEEKDAYS}
+    return days or set(range(7))
+
+def duration_of(service: Optional[dict]) -> timedelta:
+    return timedelta(minutes=(service or {}).get('duration_minutes') or DEFAULT_DURATION_MINUTES)
+
+def service_duration(service_id: Optional[str]) -> timedelta:
+    """Duration from this worker's cache only; reservations use appointment_duration"""
+    return duration_of(catalog_cache.cached("services", service_id) if service_id else None)
+
+async def appointment_duration(appointment: dict) -> timedelta:
+    """An appointment's length, reading the service from MongoDB if this worker hasn't cached it yet"""
+    service_id = appointment.get('service_id')
+    return duration_of(await catalog_cache.get("services", service_id) if service_id else None)
+
+class AvailabilityIndex:
+    """
+    Booked intervals per doctor, for free-slot queries without touching MongoDB.
+    
+    Each doctor has a list of (start, end, appointment_id) sorted by start. Writes
+    on this worker update it in place; a periodic rebuild picks up bookings made
+    by other workers.
+    """
+    
+    def __init__(self, refresh_seconds: float):
+        self.refresh_seconds = refresh_seconds
+        self._intervals = {}  # doctor_id -> sorted [(start, end, appointment_id)]
+        self._appointments = {}  # appointment_id -> (doctor_id, start, end)
+        self._longest = timedelta(minutes=DEFAULT_DURATION_MINUTES)
+        self._task = None
+        self.last_rebuild_at = None
+    
+    def upsert(self, appointment: dict, duration: Optional[timedelta] = None):
+        """Index an appointment after it was created or changed; cancelled ones are dropped"""
+        self.remove(appointment['id'])
+        if appointment.get('status') == AppointmentStatus.CANCELLED:
+            return
+        start = appointment['appointment_date']
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+        duration = duration or service_duration(appointment.get('service_id'))
+        self._longest = max(self._longest, duration)
+        entry = (start, start + duration, appointment['id'])
+        bisect.insort(self._intervals.setdefault(appointment['doctor_id'], []), entry)
+        self._appointments[appointment['id']] = (appointment['doctor_id'], entry)
+    
+    def remove(self, appointment_id: str):
+        indexed = self._appointments.pop(appointment_id, None)
+        if indexed:
+            doctor_id, entry = indexed
+            intervals = self._intervals[doctor_id]
+            del intervals[bisect.bisect_left(intervals, entry)]
+    
+    def busy(self, doctor_id: str, window_start: datetime, window_end: datetime) -> List[tuple]:
+        """Merged busy intervals of a doctor overlapping [window_start, window_end)"""
+        intervals = self._intervals.get(doctor_id, [])
+        # Nothing starting before window_start - longest booking can reach into the window
+        i = bisect.bisect_left(intervals, (window_start - self._longest,))
+        merged = []
+        while i < len(intervals) and intervals[i][0] < window_end:
+            start, end, _ = intervals[i]
+            if end > window_start:
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            i += 1
+        return merged
+    
+    def free_slots(self, doctor: dict, first_day: date, last_day: date, duration: timedelta) -> List[AvailabilityDay]:
+        """Free start times per day for a booking of the given duration"""
+        now = datetime.now(timezone.utc)
+        step = timedelta(minutes=SLOT_MINUTES)
+        weekdays = doctor_weekdays(doctor)
+        days = []
+        day = first_day
+        while day <= last_day:
+            slots = []
+            if day.weekday() in weekdays:
+                for shift_start, shift_end in CLINIC_SHIFTS:
+                    window_start = datetime.combine(day, shift_start, CLINIC_TIMEZONE).astimezone(timezone.utc)
+                    window_end = datetime.combine(day, shift_end, CLINIC_TIMEZONE).astimezone(timezone.utc)
+                    busy = self.busy(doctor['id'], window_start, window_end)
+                    b = 0
+                    slot = window_start
+                    while slot + duration <= window_end:
+                        while b < len(busy) and busy[b][1] <= slot:
+                            b += 1
+                        if b < len(busy) and busy[b][0] < slot + duration:
+                            # Overlaps this booking: jump to the first grid slot after it
+                            skip = -(-(busy[b][1] - slot) // step)
+                            slot += skip * step
+                            continue
+                        if slot > now:
+                            slots.append(slot)
+                        slot += step
+            days.append(AvailabilityDay(date=day, slots=slots))
+            day += timedelta(days=1)
+        return days
+    
+    async def rebuild(self):
+        """Reload every upcoming, non-cancelled booking from MongoDB"""
+        intervals = {}
+        appointments = {}
+        longest = timedelta(minutes=DEFAULT_DURATION_MINUTES)
+        query = {
+            "appointment_date": {"$gte": datetime.now(timezone.utc) - timedelta(days=1)},
+            "status": {"$ne": AppointmentStatus.CANCELLED}
+        }
+        projection = {"_id": 0, "id": 1, "doctor_id": 1, "service_id": 1, "appointment_date": 1}
+        async for apt in db.appointments.find(query, projection):
+            duration = service_duration(apt.get('service_id'))
+            longest = max(longest, duration)
+            entry = (apt['appointment_date'], apt['appointment_date'] + duration, apt['id'])
+            intervals.setdefault(apt['doctor_id'], []).append(entry)
+            appointments[apt['id']] = (apt['doctor_id'], entry)
+        for doctor_intervals in intervals.values():
+            doctor_intervals.sort()
+        self._intervals, self._appointments, self._longest = intervals, appointments, longest
+        self.last_rebuild_at = datetime.now(timezone.utc)
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.rebuild()
+            except Exception as e:
+                print(f"❌ Availability index rebuild failed: {str(e)}")
+    
+    def metrics(self) -> dict:
+        return {
+            "bookings": len(self._appointments),
+            "doctors": len(self._intervals),
+            "last_rebuild_at": self.last_rebuild_at
+        }
+
+availability_index = AvailabilityIndex(AVAILABILITY_REFRESH_SECONDS)
+
+# Slot reservations: each SLOT_MINUTES slot an appointment covers is a document in
+# the reservations collection, unique on (doctor_id, slot_start). Taking slots is an
+# insert, so bookings racing for the same time are settled by the unique index in
+# one round trip, without locks; the loser gets a duplicate key error.
+RESERVATIONS_BACKFILL = "reservations_backfill"
+SLOT_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def reservation_slots(appointment: dict, duration: timedelta) -> List[datetime]:
+    """Grid slots covered by an appointment, from its start rounded down to its end"""
+    start = appointment['appointment_date']
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    end = start + duration
+    step = timedelta(minutes=SLOT_MINUTES)
+    slot = start - (start - SLOT_EPOCH) % step
+    slots = []
+    while slot < end:
+        slots.append(slot)
+        slot += step
+    return slots
+
+SLOT_FIELDS = ("doctor_id", "service_id", "appointment_date")
+
+def reservations_change(old: dict, new: dict) -> bool:
+    """Whether an edit moves an appointment's slots (time, doctor, service or (un)cancelling)"""
+    cancelled = AppointmentStatus.CANCELLED
+    return (
+        any(old.get(field) != new.get(field) for field in SLOT_FIELDS)
+        or (old['status'] == cancelled) != (new['status'] == cancelled)
+    )
+
+async def reserve_slots(appointment_id: str, doctor_id: str, slots: List[datetime]) -> bool:
+    """Take all the slots for an appointment, or none of them if any is already taken"""
+    if not slots:
+        return True
+    try:
+        await db.reservations.insert_many(
+            [{"doctor_id": doctor_id, "slot_start": slot, "appointment_id": appointment_id} for slot in slots],
+            ordered=True
+        )
+        return True
+    except BulkWriteError as e:
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+        # Give back the slots inserted before the conflicting one
+        await db.reservations.delete_many({"appointment_id": appointment_id, "doctor_id": doctor_id, "slot_start": {"$in": slots}})
+        return False
+
+async def take_reservations(appointment: dict, duration: Optional[timedelta] = None) -> Optional[tuple]:
+    """
+    Reserve the slots an appointment needs and doesn't hold yet
+    Returns (taken, stale): the slots just taken, and the held ones it no longer
+    needs, to release once the edit is saved. Returns None (taking nothing) if
+    one of them belongs to another appointment.
+    """
+    held = {
+        (reservation['doctor_id'], reservation['slot_start'])
+        for reservation in await db.reservations.find(
+            {"appointment_id": appointment['id']}, {"_id": 0, "doctor_id": 1, "slot_start": 1}
+        ).to_list(None)
+    }
+    wanted = set()
+    if appointment.get('status') != AppointmentStatus.CANCELLED:
+        duration = duration or await appointment_duration(appointment)
+        wanted = {(appointment['doctor_id'], slot) for slot in reservation_slots(appointment, duration)}
+    
+    taken = wanted - held
+    if taken and not await reserve_slots(appointment['id'], appointment['doctor_id'], [slot for _, slot in sorted(taken)]):
+        return None
+    return taken, held - wanted
+
+async def release_reservations(appointment_id: str, slots: set):
+    """Give up (doctor_id, slot_start) reservations held by an appointment"""
+    if slots:
+        await db.reservations.delete_many({
+            "appointment_id": appointment_id,
+            "$or": [{"doctor_id": doctor_id, "slot_start": slot} for doctor_id, slot in slots]
+        })
+
+async def sync_reservations(appointment: dict, duration: Optional[timedelta] = None) -> bool:
+    """
+    Make an appointment's reservations match its doctor, time, service and status
+    New slots are taken before old ones are released; returns False (changing
+    nothing) if one of them belongs to another appointment.
+    """
+    reserved = await take_reservations(appointment, duration)
+    if reserved is None:
+        return False
+    await release_reservations(appointment['id'], reserved[1])
+    return True
+
+async def backfill_reservations() -> dict:
+    """Reserve the slots of upcoming appointments booked before reservations existed (once)"""
+    if await db.migrations.find_one({"_id": RESERVATIONS_BACKFILL}):
+        return {"reserved": 0, "conflicts": 0}
+    
+    reserved = conflicts = 0
+    query = {"appointment_date": {"$gte": datetime.now(timezone.utc)}, "status": {"$ne": AppointmentStatus.CANCELLED}}
+    async for apt in db.appointments.find(query, {"_id": 0, "id": 1, "doctor_id": 1, "service_id": 1, "appointment_date": 1}):
+        docs = [{"doctor_id": apt['doctor_id'], "slot_start": slot, "appointment_id": apt['id']}
+                for slot in reservation_slots(apt, await appointment_duration(apt))]
+        try:
+            await db.reservations.insert_many(docs, ordered=False)
+            reserved += len(docs)
+        except BulkWriteError as e:
+            # Existing double bookings: the earlier one keeps the slot
+            duplicates = len([error for error in e.details.get("writeErrors", []) if error.get("code") == 11000])
+            reserved += len(docs) - duplicates
+            conflicts += duplicates
+    
+    await db.migrations.insert_one({"_id": RESERVATIONS_BACKFILL, "completed_at": datetime.now(timezone.utc)})
+    return {"reserved": reserved, "conflicts": conflicts}
+
+async def resize_reservations(service_id: str, duration: timedelta) -> dict:
+    """After a service's duration changed, re-reserve its upcoming appointments at the new length"""
+    resized = conflicts = 0
+    query = {"service_id": service_id, "appointment_date": {"$gte": datetime.now(timezone.utc)}, "status": {"$ne": AppointmentStatus.CANCELLED}}
+    async for apt in db.appointments.find(query, {"_id": 0, "id": 1, "doctor_id": 1, "service_id": 1, "appointment_date": 1, "status": 1}):
+        if await sync_reservations(apt, duration):
+            resized += 1
+            availability_index.upsert(apt, duration)
+        else:
+            # Now overlaps the next booking: it keeps its old slots until someone moves one of them
+            conflicts += 1
+            print(f"⚠️ Appointment {apt['id']} overlaps another booking at the new duration of service {service_id}")
+    return {"resized": resized, "conflicts": conflicts}
+
+# Bulk appointment operations: a batch is validated against one read of the
+# appointments and reservations it touches, its slots are taken with one insert
+# and its writes applied with one bulk_write. Failures are reported per item.
+BULK_MAX_OPERATIONS = int(os.environ.get("BULK_MAX_OPERATIONS", "500"))
+
+async def plan_bulk_operations(operations: List[BulkAppointmentOperation], results: list) -> List[dict]:
+    """
+    Validate a batch and resolve each item to {"index", "old", "new", "update"}
+    (old and update are None for creates); failures are written to results.
+    """
+    def fail(index, status_code, detail):
+        results[index] = BulkAppointmentResult(index=index, status_code=status_code, detail=detail)
+    
+    update_ids = [op.appointment_id for op in operations if op.appointment_id]
+    existing = {}
+    if update_ids:
+        async for apt in db.appointments.find({"id": {"$in": update_ids}}, {"_id": 0}):
+            existing[apt['id']] = apt
+    
+    planned = []
+    seen = set()
+    for index, op in enumerate(operations):
+        if (op.create is None) == (op.update is None) or bool(op.appointment_id) != (op.update is not None):
+            fail(index, 400, "Each operation needs either create, or appointment_id and update")
+            continue
+        
+        if op.create:
+            doctor = await catalog_cache.get("doctors", op.create.doctor_id)
+            service = await catalog_cache.get("services", op.create.service_id)
+            if not doctor or not service:
+                fail(index, 404, "Doctor not found" if not doctor else "Service not found")
+                continue
+            new = to_document(new_appointment(op.create, doctor, service))
+            planned.append({"index": index, "old": None, "new": new, "update": None})
+            continue
+        
+        old = existing.get(op.appointment_id)
+        if not old:
+            fail(index, 404, "Appointment not found")
+            continue
+        if op.appointment_id in seen:
+            fail(index, 400, "Appointment appears more than once in the batch")
+            continue
+        seen.add(op.appointment_id)
+        
+        if op.update.version is not None and op.update.version != old.get("version", 0):
+            fail(index, 409, VERSION_CONFLICT_DETAIL)
+            continue
+        
+        update_data = {k: v for k, v in op.update.model_dump(exclude={"version"}).items() if v is not None}
+        if update_data.get("appointment_date"):
+            # As MongoDB will return it, so the lost-update check below compares equal:
+            # stored as UTC either way, and BSON dates keep only milliseconds
+            appointment_date = update_data["appointment_date"]
+            if appointment_date.tzinfo is None:
+                appointment_date = appointment_date.replace(tzinfo=timezone.utc)
+            update_data["appointment_date"] = appointment_date.replace(microsecond=appointment_date.microsecond // 1000 * 1000)
+        if "doctor_id" in update_data:
+            doctor = await catalog_cache.get("doctors", update_data["doctor_id"])
+            if not doctor:
+                fail(index, 404, "Doctor not found")
+                continue
+            update_data["doctor_name"] = doctor['name']
+        if "service_id" in update_data:
+            service = await catalog_cache.get("services", update_data["service_id"])
+            if not service:
+                fail(index, 404, "Service not found")
+                continue
+            update_data["service_name"] = service['name']
+        new = {**old, **update_data, "version": old.get("version", 0) + 1}
+        planned.append({"index": index, "old": old, "new": new, "update": update_data})
+    
+    return planned
+
+async def reserve_bulk_slots(planned: List[dict], results: list) -> List[dict]:
+    """
+    Take the slots of every planned item with one insert; items that lost a slot
+    (to another appointment or an earlier item) get a 409 and are dropped.
+    As in update_appointment, old slots are only released once the write has
+    landed (item["stale"]), so swapping two appointments needs two batches.
+    """
+    held = {}
+    update_ids = [item["new"]["id"] for item in planned if item["update"] is not None]
+    if update_ids:
+        async for reservation in db.reservations.find({"appointment_id": {"$in": update_ids}}, {"_id": 0}):
+            held.setdefault(reservation['appointment_id'], set()).add((reservation['doctor_id'], reservation['slot_start']))
+    
+    claimed = set()
+    taking = []
+    reserving = []
+    for item in planned:
+        new = item["new"]
+        if item["update"] is not None and not reservations_change(item["old"], new):
+            continue
+        item["held"] = held.get(new['id'], set())
+        item["wanted"] = set()
+        if new['status'] != AppointmentStatus.CANCELLED:
+            item["wanted"] = {(new['doctor_id'], slot) for slot in reservation_slots(new, await appointment_duration(new))}
+        take = item["wanted"] - item["held"]
+        if take & claimed:
+            results[item["index"]] = BulkAppointmentResult(index=item["index"], status_code=409, detail="هذا الموعد محجوز، يرجى اختيار وقت آخر")
+            item["failed"] = True
+            continue
+        claimed |= take
+        reserving.append(item)
+        taking += [{"doctor_id": doctor_id, "slot_start": slot, "appointment_id": new['id']} for doctor_id, slot in sorted(take)]
+    
+    conflicted = set()
+    if taking:
+        try:
+            await db.reservations.insert_many(taking, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            conflicted = {taking[error["index"]]["appointment_id"] for error in errors}
+            # Give back what the losing items did manage to take
+            await db.reservations.delete_many({"$or": [
+                {"appointment_id": doc["appointment_id"], "doctor_id": doc["doctor_id"], "slot_start": doc["slot_start"]}
+                for doc in taking if doc["appointment_id"] in conflicted
+            ]})
+    
+    for item in reserving:
+        if item["new"]['id'] in conflicted:
+            results[item["index"]] = BulkAppointmentResult(index=item["index"], status_code=409, detail="هذا الموعد محجوز، يرجى اختيار وقت آخر")
+            item["failed"] = True
+        else:
+            item["stale"] = item["held"] - item["wanted"]
+    
+    return [item for item in planned if not item.get("failed")]
+
+def availability_range(start: Optional[date], end: Optional[date]) -> tuple:
+    """Validate a requested date range; defaults to the next 7 days"""
+    first_day = start or datetime.now(CLINIC_TIMEZONE).date()
+    last_day = end or first_day + timedelta(days=6)
+    if last_day < first_day:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    if (last_day - first_day).days >= AVAILABILITY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range is limited to {AVAILABILITY_MAX_DAYS} days")
+    return first_day, last_day
+
+async def availability_duration(service_id: Optional[str]) -> timedelta:
+    if not service_id:
+        return timedelta(minutes=DEFAULT_DURATION_MINUTES)
+    service = await catalog_cache.get("services", service_id)
+    if not service:
+        raise HTTPException(status_code=404, detail="Service not found")
+    return timedelta(minutes=service.get('duration_minutes') or DEFAULT_DURATION_MINUTES)
+
 # Admin Auth Models
 class AdminLogin(BaseModel):
     username: str
@@ -347,12 +2250,31 @@ class AdminUser(BaseModel):
     role: UserRole = UserRole.ADMIN
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+# bcrypt costs ~250 ms of CPU per call, so it runs on a dedicated thread pool
+# instead of the event loop. At most PASSWORD_HASH_CONCURRENCY hashes run at once;
+# a caller that can't get a slot within PASSWORD_HASH_QUEUE_TIMEOUT gets a 503.
+PASSWORD_HASH_CONCURRENCY = int(os.environ.get("PASSWORD_HASH_CONCURRENCY", "2"))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.environ.get("PASSWORD_HASH_QUEUE_TIMEOUT", "5"))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_CONCURRENCY, thread_name_prefix="bcrypt")
+password_slots = asyncio.Semaphore(PASSWORD_HASH_CONCURRENCY)
+
+async def run_password_hash(function, *args):
+    """Run a passlib call on the password pool"""
+    try:
+        await asyncio.wait_for(password_slots.acquire(), PASSWORD_HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="الخادم مشغول، يرجى المحاولة بعد قليل")
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, function, *args)
+    finally:
+        password_slots.release()
+
 # Helper function to verify password
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await run_password_hash(pwd_context.verify, plain_password, hashed_password)
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def hash_password(password: str) -> str:
+    return await run_password_hash(pwd_context.hash, password)
 
 # Admin Auth Routes
 @api_router.post("/auth/admin/login")
@@ -363,7 +2285,7 @@ async def admin_login(login_data: AdminLogin):
     if not admin:
         raise HTTPException(status_code=401, detail="اسم المستخدم أو كلمة المرور غير صحيحة")
     
-    if not verify_password(login_data.password, admin['password_hash']):
+    if not await verify_password(login_data.password, admin['password_hash']):
         raise HTTPException(status_code=401, detail="اسم المستخدم أو كلمة المرور غير صحيحة")
     
     # Create token
@@ -392,11 +2314,11 @@ async def change_admin_password(change_data: ChangePasswordRequest):
         raise HTTPException(status_code=404, detail="المستخدم غير موجود")
     
     # Verify current password
-    if not verify_password(change_data.current_password, admin['password_hash']):
+    if not await verify_password(change_data.current_password, admin['password_hash']):
         raise HTTPException(status_code=401, detail="كلمة المرور الحالية غير صحيحة")
     
     # Hash new password
-    new_password_hash = hash_password(change_data.new_password)
+    new_password_hash = await hash_password(change_data.new_password)
     
     # Update password
     await db.admin_users.update_one(
@@ -411,15 +2333,8 @@ async def change_admin_password(change_data: ChangePasswordRequest):
 async def send_otp(user_data: UserCreate):
     """Send OTP to phone number"""
     otp = generate_otp()
-    # Store OTP in database with expiry
-    otp_data = {
-        "phone": user_data.phone,
-        "otp": otp,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(minutes=5)).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.otps.delete_many({"phone": user_data.phone})  # Delete old OTPs
-    await db.otps.insert_one(otp_data)
+    # Replaces any earlier OTP for this phone
+    await otp_store.issue(user_data.phone, otp)
     
     # TODO: Integrate with SMS provider
     # For now, return OTP in response (only for development)
@@ -428,30 +2343,28 @@ async def send_otp(user_data: UserCreate):
 @api_router.post("/auth/verify-otp")
 async def verify_otp(verify_data: OTPVerify):
     """Verify OTP and create/login user"""
-    # Check OTP
-    otp_record = await db.otps.find_one({"phone": verify_data.phone, "otp": verify_data.otp})
-    if not otp_record:
-        raise HTTPException(status_code=400, detail="Invalid OTP")
-    
-    # Check expiry
-    expires_at = datetime.fromisoformat(otp_record['expires_at'])
-    if datetime.now(timezone.utc) > expires_at:
+    # Check and consume the OTP in one step
+    status = await otp_store.consume(verify_data.phone, verify_data.otp)
+    if status == OTPStatus.EXPIRED:
         raise HTTPException(status_code=400, detail="OTP expired")
-    
-    # Delete used OTP
-    await db.otps.delete_one({"phone": verify_data.phone})
+    if status == OTPStatus.LOCKED:
+        raise HTTPException(status_code=429, detail="Too many attempts, request a new OTP")
+    if status != OTPStatus.VALID:
+        raise HTTPException(status_code=400, detail="Invalid OTP")
     
     # Find or create user
     user_doc = await db.users.find_one({"phone": verify_data.phone}, {"_id": 0})
     if user_doc:
-        if isinstance(user_doc['created_at'], str):
-            user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
         user = User(**user_doc)
     else:
         user = User(phone=verify_data.phone, role=UserRole.PATIENT)
-        doc = user.model_dump()
-        doc['created_at'] = doc['created_at'].isoformat()
+        doc = to_document(user)
         await db.users.insert_one(doc)
+        await bump_stats({"total_patients": 1})
+        # Campaigns broadcast before the user joined stay out of their feed
+        await db.notification_counters.update_one(
+            {"_id": user.id}, {"$set": {"joined_at": user.created_at}}, upsert=True
+        )
     
     # Create token
     token = create_access_token({"user_id": user.id, "phone": user.phone, "role": user.role})
@@ -460,114 +2373,152 @@ async def verify_otp(verify_data: OTPVerify):
 
 # User Routes
 @api_router.get("/users/me")
-async def get_current_user(token: str):
+async def get_current_user(auth: dict = Depends(require_user)):
     """Get current user info"""
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if not user_doc:
-            raise HTTPException(status_code=404, detail="User not found")
-        if isinstance(user_doc['created_at'], str):
-            user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-        return User(**user_doc)
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    # Admin tokens resolve to admin_users, which have no patient profile
+    if auth["claims"].get("role") == UserRole.ADMIN:
+        raise HTTPException(status_code=404, detail="User not found")
+    return User(**auth["user"])
 
 @api_router.put("/users/me")
-async def update_user(token: str, name: Optional[str] = None, fcm_token: Optional[str] = None):
+async def update_user(name: Optional[str] = None, fcm_token: Optional[str] = None, auth: dict = Depends(require_user)):
     """Update user profile"""
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        update_data = {}
-        if name:
-            update_data["name"] = name
-        if fcm_token:
-            update_data["fcm_token"] = fcm_token
-        
-        if update_data:
-            await db.users.update_one({"id": user_id}, {"$set": update_data})
-        
-        user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if isinstance(user_doc['created_at'], str):
-            user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-        return User(**user_doc)
-    except jwt.JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    if auth["claims"].get("role") == UserRole.ADMIN:
+        raise HTTPException(status_code=404, detail="User not found")
+    user_id = auth["user"]["id"]
+    update_data = {}
+    if name:
+        update_data["name"] = name
+    if fcm_token:
+        update_data["fcm_token"] = fcm_token
+    
+    if update_data:
+        await db.users.update_one({"id": user_id}, {"$set": update_data})
+    
+    if fcm_token:
+        # Link the OneSignal device to the user so pushes can target the user id.
+        # The client also logs the device in as the user; this covers older builds.
+        await enqueue_push(
+            {"app_id": ONESIGNAL_APP_ID, "external_user_id": user_id},
+            "device",
+            user_id,
+            url=f"{ONESIGNAL_PLAYERS_URL}/{fcm_token}",
+            method="PUT"
+        )
+    
+    user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
+    # Keep this token's cached copy current; other sessions catch up within AUTH_CACHE_TTL
+    auth_cache[auth["key"]] = {**auth, "user": user_doc}
+    return User(**user_doc)
 
 # Doctor Routes
 @api_router.post("/doctors", response_model=Doctor)
 async def create_doctor(doctor: DoctorCreate):
     doctor_obj = Doctor(**doctor.model_dump())
-    doc = doctor_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
+    doc = to_document(doctor_obj)
     await db.doctors.insert_one(doc)
+    await bump_stats({"total_doctors": 1})
+    await catalog_cache.invalidate()
     return doctor_obj
 
 @api_router.get("/doctors", response_model=List[Doctor])
-async def get_doctors():
-    doctors = await db.doctors.find({}, {"_id": 0}).to_list(1000)
-    for doctor in doctors:
-        if isinstance(doctor['created_at'], str):
-            doctor['created_at'] = datetime.fromisoformat(doctor['created_at'])
-    return doctors
+async def get_doctors(request: Request, response: Response, limit: int = Query(PAGE_SIZE_MAX, ge=1, le=PAGE_SIZE_MAX), after: Optional[str] = None):
+    doctors = catalog_cache.page("doctors", limit, after, response)
+    return list_response(Doctor, doctors, request, response)
 
 @api_router.get("/doctors/{doctor_id}", response_model=Doctor)
 async def get_doctor(doctor_id: str):
-    doctor = await db.doctors.find_one({"id": doctor_id}, {"_id": 0})
+    doctor = await catalog_cache.get("doctors", doctor_id)
     if not doctor:
         raise HTTPException(status_code=404, detail="Doctor not found")
-    if isinstance(doctor['created_at'], str):
-        doctor['created_at'] = datetime.fromisoformat(doctor['created_at'])
     return Doctor(**doctor)
 
+@api_router.put("/doctors/{doctor_id}", response_model=Doctor)
+async def update_doctor(doctor_id: str, update: DoctorUpdate):
+    update_data = {k: v for k, v in update.model_dump(exclude={"version"}).items() if v is not None}
+    doctor = await versioned_update(db.doctors, "Doctor", doctor_id, update.version, update_data)
+    if update_data:
+        await catalog_cache.invalidate()
+    return Doctor(**doctor)
+
+@api_router.get("/doctors/{doctor_id}/availability", response_model=DoctorAvailability)
+async def get_doctor_availability(doctor_id: str, start: Optional[date] = None, end: Optional[date] = None, service_id: Optional[str] = None):
+    """
+    Free appointment slots of one doctor
+    start/end: Inclusive clinic-local dates (default: the next 7 days)
+    service_id: Size slots for this service's duration (default 30 minutes)
+    """
+    doctor = await catalog_cache.get("doctors", doctor_id)
+    if not doctor:
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    first_day, last_day = availability_range(start, end)
+    duration = await availability_duration(service_id)
+    return DoctorAvailability(
+        doctor_id=doctor['id'],
+        doctor_name=doctor['name'],
+        duration_minutes=duration // timedelta(minutes=1),
+        days=availability_index.free_slots(doctor, first_day, last_day, duration)
+    )
+
+@api_router.get("/availability", response_model=List[DoctorAvailability])
+async def get_availability(start: Optional[date] = None, end: Optional[date] = None, service_id: Optional[str] = None):
+    """Free appointment slots of every doctor (same parameters as the per-doctor route)"""
+    first_day, last_day = availability_range(start, end)
+    duration = await availability_duration(service_id)
+    return [
+        DoctorAvailability(
+            doctor_id=doctor['id'],
+            doctor_name=doctor['name'],
+            duration_minutes=duration // timedelta(minutes=1),
+            days=availability_index.free_slots(doctor, first_day, last_day, duration)
+        )
+        for doctor in catalog_cache.all("doctors")
+    ]
+
 @api_router.delete("/doctors/{doctor_id}")
 async def delete_doctor(doctor_id: str):
     result = await db.doctors.delete_one({"id": doctor_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Doctor not found")
+    await bump_stats({"total_doctors": -1})
+    await catalog_cache.invalidate()
     return {"message": "Doctor deleted successfully"}
 
 # Service Routes
 @api_router.post("/services", response_model=Service)
 async def create_service(service: ServiceCreate):
     service_obj = Service(**service.model_dump())
-    doc = service_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
+    doc = to_document(service_obj)
     await db.services.insert_one(doc)
+    await catalog_cache.invalidate()
     return service_obj
 
 @api_router.get("/services", response_model=List[Service])
-async def get_services():
-    services = await db.services.find({}, {"_id": 0}).to_list(1000)
-    for service in services:
-        if isinstance(service['created_at'], str):
-            service['created_at'] = datetime.fromisoformat(service['created_at'])
-    return services
+async def get_services(request: Request, response: Response, limit: int = Query(PAGE_SIZE_MAX, ge=1, le=PAGE_SIZE_MAX), after: Optional[str] = None):
+    services = catalog_cache.page("services", limit, after, response)
+    return list_response(Service, services, request, response)
+
+@api_router.put("/services/{service_id}", response_model=Service)
+async def update_service(service_id: str, update: ServiceUpdate):
+    update_data = {k: v for k, v in update.model_dump(exclude={"version"}).items() if v is not None}
+    service = await versioned_update(db.services, "Service", service_id, update.version, update_data)
+    if update_data:
+        await catalog_cache.invalidate()
+    if "duration_minutes" in update_data:
+        await resize_reservations(service_id, duration_of(service))
+    return Service(**service)
 
 @api_router.delete("/services/{service_id}")
 async def delete_service(service_id: str):
     result = await db.services.delete_one({"id": service_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Service not found")
+    await catalog_cache.invalidate()
     return {"message": "Service deleted successfully"}
 
 # Appointment Routes
-@api_router.post("/appointments", response_model=Appointment)
-async def create_appointment(appointment: AppointmentCreate):
-    # Get doctor and service info
-    doctor = await db.doctors.find_one({"id": appointment.doctor_id}, {"_id": 0})
-    if not doctor:
-        raise HTTPException(status_code=404, detail="Doctor not found")
-    
-    service = await db.services.find_one({"id": appointment.service_id}, {"_id": 0})
-    if not service:
-        raise HTTPException(status_code=404, detail="Service not found")
-    
-    appointment_obj = Appointment(
+def new_appointment(appointment: AppointmentCreate, doctor: dict, service: dict) -> Appointment:
+    return Appointment(
         patient_id=appointment.patient_id or "",
         patient_name=appointment.patient_name,
         patient_phone=appointment.patient_phone,
@@ -579,16 +2530,46 @@ async def create_appointment(appointment: AppointmentCreate):
         notes=appointment.notes,
         created_by=appointment.created_by
     )
+
+@api_router.post("/appointments", response_model=Appointment)
+async def create_appointment(appointment: AppointmentCreate):
+    # Get doctor and service info
+    doctor = await catalog_cache.get("doctors", appointment.doctor_id)
+    if not doctor:
+        raise HTTPException(status_code=404, detail="Doctor not found")
     
-    doc = appointment_obj.model_dump()
-    doc['appointment_date'] = doc['appointment_date'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.appointments.insert_one(doc)
+    service = await catalog_cache.get("services", appointment.service_id)
+    if not service:
+        raise HTTPException(status_code=404, detail="Service not found")
+    
+    appointment_obj = new_appointment(appointment, doctor, service)
+    doc = to_document(appointment_obj)
+    # The service was just read (from MongoDB if this worker hadn't cached it yet)
+    duration = duration_of(service)
+    if not await reserve_slots(doc['id'], doc['doctor_id'], reservation_slots(doc, duration)):
+        raise HTTPException(status_code=409, detail="هذا الموعد محجوز، يرجى اختيار وقت آخر")
+    try:
+        await db.appointments.insert_one(doc)
+    except Exception:
+        await db.reservations.delete_many({"appointment_id": doc['id']})
+        raise
+    await bump_stats(appointment_status_deltas(None, doc['status']))
+    reminder_engine.schedule(doc)
+    availability_index.upsert(doc, duration)
     
     return appointment_obj
 
 @api_router.get("/appointments", response_model=List[Appointment])
-async def get_appointments(status: Optional[str] = None, patient_id: Optional[str] = None, patient_phone: Optional[str] = None):
+async def get_appointments(
+    request: Request,
+    response: Response,
+    status: Optional[str] = None,
+    patient_id: Optional[str] = None,
+    patient_phone: Optional[str] = None,
+    limit: int = Query(PAGE_SIZE_MAX, ge=1, le=PAGE_SIZE_MAX),
+    after: Optional[str] = None
+):
+    """Appointments, newest first, one page at a time (see find_page)"""
     query = {}
     if status:
         query["status"] = status
@@ -597,136 +2578,264 @@ async def get_appointments(status: Optional[str] = None, patient_id: Optional[st
     if patient_phone:
         query["patient_phone"] = patient_phone
     
-    appointments = await db.appointments.find(query, {"_id": 0}).to_list(1000)
-    for apt in appointments:
-        if isinstance(apt['appointment_date'], str):
-            apt['appointment_date'] = datetime.fromisoformat(apt['appointment_date'])
-        if isinstance(apt['created_at'], str):
-            apt['created_at'] = datetime.fromisoformat(apt['created_at'])
-    return appointments
+    appointments = await find_page(db.appointments, query, "appointment_date", DESCENDING, limit, after, response, model_projection(Appointment))
+    return list_response(Appointment, appointments, request, response)
 
 @api_router.get("/appointments/{appointment_id}", response_model=Appointment)
 async def get_appointment(appointment_id: str):
     apt = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
     if not apt:
         raise HTTPException(status_code=404, detail="Appointment not found")
-    if isinstance(apt['appointment_date'], str):
-        apt['appointment_date'] = datetime.fromisoformat(apt['appointment_date'])
-    if isinstance(apt['created_at'], str):
-        apt['created_at'] = datetime.fromisoformat(apt['created_at'])
     return Appointment(**apt)
 
 @api_router.put("/appointments/{appointment_id}", response_model=Appointment)
 async def update_appointment(appointment_id: str, update: AppointmentUpdate):
-    apt = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
-    if not apt:
-        raise HTTPException(status_code=404, detail="Appointment not found")
-    
-    update_data = {k: v for k, v in update.model_dump().items() if v is not None}
+    update_data = {k: v for k, v in update.model_dump(exclude={"version"}).items() if v is not None}
     
     # Update doctor/service names if IDs changed
     if "doctor_id" in update_data:
-        doctor = await db.doctors.find_one({"id": update_data["doctor_id"]}, {"_id": 0})
+        doctor = await catalog_cache.get("doctors", update_data["doctor_id"])
         if doctor:
             update_data["doctor_name"] = doctor['name']
     
     if "service_id" in update_data:
-        service = await db.services.find_one({"id": update_data["service_id"]}, {"_id": 0})
+        service = await catalog_cache.get("services", update_data["service_id"])
         if service:
             update_data["service_name"] = service['name']
     
-    if "appointment_date" in update_data:
-        update_data["appointment_date"] = update_data["appointment_date"].isoformat()
+    if not update_data:
+        apt = await versioned_update(db.appointments, "Appointment", appointment_id, update.version, update_data)
+        return Appointment(**apt)
     
-    if update_data:
-        await db.appointments.update_one({"id": appointment_id}, {"$set": update_data})
+    previous = None
+    if not update_data.keys() & set(SLOT_FIELDS) and update_data.get("status") != AppointmentStatus.CANCELLED:
+        # Slots only move when an appointment leaves or enters cancelled, so unless it
+        # is cancelled now this is one round trip; the document comes back as it was,
+        # so the updated one is the merge
+        query = versioned_filter(appointment_id, update.version)
+        if "status" in update_data:
+            query["status"] = {"$ne": AppointmentStatus.CANCELLED}
+        previous = await db.appointments.find_one_and_update(
+            query,
+            {"$set": update_data, "$inc": {"version": 1}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+        if previous is not None:
+            apt = {**previous, **update_data, "version": previous.get("version", 0) + 1}
     
-    apt = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
-    if isinstance(apt['appointment_date'], str):
-        apt['appointment_date'] = datetime.fromisoformat(apt['appointment_date'])
-    if isinstance(apt['created_at'], str):
-        apt['created_at'] = datetime.fromisoformat(apt['created_at'])
+    if previous is None:
+        # As on create, the new slots are reserved before anything is written, so a
+        # taken slot rejects the edit with the document untouched. The write is
+        # conditioned on the version read here, the one the reservations were made for.
+        previous = await versioned_find(db.appointments, "Appointment", appointment_id, update.version)
+        apt = {**previous, **update_data, "version": previous.get("version", 0) + 1}
+        taken, stale = set(), set()
+        if reservations_change(previous, apt):
+            reserved = await take_reservations(apt)
+            if reserved is None:
+                raise HTTPException(status_code=409, detail="هذا الموعد محجوز، يرجى اختيار وقت آخر")
+            taken, stale = reserved
+        
+        result = await db.appointments.update_one(
+            versioned_filter(appointment_id, previous.get("version", 0)),
+            {"$set": update_data, "$inc": {"version": 1}}
+        )
+        if not result.matched_count:
+            # Edited or deleted since the read: give the new slots back
+            await release_reservations(appointment_id, taken)
+            raise await version_miss(db.appointments, "Appointment", appointment_id, previous.get("version", 0))
+        await release_reservations(appointment_id, stale)
+    
+    if "status" in update_data:
+        await bump_stats(appointment_status_deltas(previous['status'], apt['status']))
+    reminder_engine.schedule(apt)
+    availability_index.upsert(apt, await appointment_duration(apt))
     
     # Send notification if status changed to confirmed
     if update.status == AppointmentStatus.CONFIRMED:
-        # Check if patient_phone exists (always present in appointments)
-        if apt.get('patient_phone'):
-            # Send in-app notification (only if patient has an ID)
-            if apt.get('patient_id') and apt['patient_id']:
-                await send_notification(
-                    apt['patient_id'],
-                    "تم تأكيد موعدك",
-                    f"تم تأكيد موعدك مع د. {apt['doctor_name']} في {apt['appointment_date']}",
-                    "reminder",
-                    appointment_id
-                )
-            
-            # Send push notification via OneSignal (for ALL patients)
-            try:
-                async with httpx.AsyncClient() as client:
-                    headers = {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Basic {ONESIGNAL_REST_API_KEY}"
-                    }
-                    
-                    # Format date nicely
-                    apt_date = datetime.fromisoformat(apt['appointment_date']) if isinstance(apt['appointment_date'], str) else apt['appointment_date']
-                    formatted_date = apt_date.strftime('%A %d %B الساعة %I:%M %p')
-                    
-                    payload = {
-                        "app_id": ONESIGNAL_APP_ID,
-                        "included_segments": ["All"],
-                        "headings": {"en": "✅ تم تأكيد موعدك", "ar": "✅ تم تأكيد موعدك"},
-                        "contents": {
-                            "en": f"موعدك مع د. {apt['doctor_name']}\n{formatted_date}\n\nنتطلع لرؤيتك 🦷",
-                            "ar": f"موعدك مع د. {apt['doctor_name']}\n{formatted_date}\n\nنتطلع لرؤيتك 🦷"
-                        },
-                        "url": "https://dental-booking-16.preview.emergentagent.com/patient/dashboard"
-                    }
-                    
-                    response = await client.post(
-                        "https://onesignal.com/api/v1/notifications",
-                        headers=headers,
-                        json=payload,
-                        timeout=10.0
-                    )
-                    
-                    if response.status_code == 200:
-                        print(f"✅ Confirmation push notification sent for patient: {apt['patient_phone']}")
-                    else:
-                        print(f"❌ Failed to send push notification: {response.text}")
-            except Exception as e:
-                print(f"Error sending OneSignal notification: {e}")
+        await notify_confirmed([apt])
     
     return Appointment(**apt)
 
+@api_router.post("/appointments/bulk", response_model=List[BulkAppointmentResult])
+async def bulk_appointments(batch: BulkAppointmentRequest, auth: dict = Depends(require_admin)):
+    """
+    Create, reschedule, re-assign or change the status of up to BULK_MAX_OPERATIONS
+    appointments at once; returns one result per operation, in order
+    """
+    operations = batch.operations
+    if len(operations) > BULK_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"A batch is limited to {BULK_MAX_OPERATIONS} operations")
+    
+    results = [None] * len(operations)
+    planned = await plan_bulk_operations(operations, results)
+    planned = await reserve_bulk_slots(planned, results)
+    
+    # Updates only apply at the version the batch read
+    writes = [
+        InsertOne(item["new"]) if item["update"] is None
+        else UpdateOne(versioned_filter(item["new"]['id'], item["old"].get("version", 0)),
+                       {"$set": item["update"], "$inc": {"version": 1}})
+        for item in planned
+    ]
+    failed = set()
+    matched = 0
+    if writes:
+        try:
+            matched = (await db.appointments.bulk_write(writes, ordered=False)).matched_count
+        except BulkWriteError as e:
+            matched = e.details.get("nMatched", 0)
+            for error in e.details.get("writeErrors", []):
+                item = planned[error["index"]]
+                failed.add(item["index"])
+                results[item["index"]] = BulkAppointmentResult(index=item["index"], status_code=500, detail=error.get("errmsg"))
+                # Hand the slots back to the appointment as it was (or to nobody)
+                await sync_reservations(item["old"] or {**item["new"], "status": AppointmentStatus.CANCELLED})
+    
+    updates = [item for item in planned if item["update"] is not None and item["index"] not in failed]
+    if matched < len(updates):
+        # Someone edited (or deleted) an appointment between the read and the write.
+        # bulk_write doesn't say which, so look for updates whose values are missing.
+        current = {}
+        async for apt in db.appointments.find({"id": {"$in": [item["new"]['id'] for item in updates]}}, {"_id": 0}):
+            current[apt['id']] = apt
+        for item in updates:
+            apt = current.get(item["new"]['id'])
+            if apt and apt.get("version", 0) > item["old"].get("version", 0) and all(
+                apt.get(k) == v for k, v in item["update"].items()
+            ):
+                continue
+            failed.add(item["index"])
+            results[item["index"]] = BulkAppointmentResult(index=item["index"], status_code=409, detail=VERSION_CONFLICT_DETAIL)
+            if apt:
+                await sync_reservations(apt)
+            else:
+                await db.reservations.delete_many({"appointment_id": item["new"]['id']})
+    
+    released = []
+    deltas = {}
+    confirmed = []
+    for item in planned:
+        if item["index"] in failed:
+            continue
+        old, new = item["old"], item["new"]
+        released += [{"appointment_id": new['id'], "doctor_id": doctor_id, "slot_start": slot}
+                     for doctor_id, slot in item.get("stale", ())]
+        for field, delta in appointment_status_deltas(old['status'] if old else None, new['status']).items():
+            deltas[field] = deltas.get(field, 0) + delta
+        reminder_engine.schedule(new)
+        availability_index.upsert(new, await appointment_duration(new))
+        if item["update"] and item["update"].get("status") == AppointmentStatus.CONFIRMED:
+            confirmed.append(new)
+        results[item["index"]] = BulkAppointmentResult(index=item["index"], status_code=200, appointment=Appointment(**new))
+    
+    if released:
+        await db.reservations.delete_many({"$or": released})
+    await bump_stats(deltas)
+    await notify_confirmed(confirmed)
+    return results
+
 @api_router.delete("/appointments/{appointment_id}")
 async def delete_appointment(appointment_id: str):
-    result = await db.appointments.delete_one({"id": appointment_id})
-    if result.deleted_count == 0:
+    deleted = await db.appointments.find_one_and_delete({"id": appointment_id}, projection={"_id": 0, "status": 1})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Appointment not found")
+    await bump_stats(appointment_status_deltas(deleted['status'], None))
+    await db.reservations.delete_many({"appointment_id": appointment_id})
+    reminder_engine.cancel(appointment_id)
+    availability_index.remove(appointment_id)
     return {"message": "Appointment deleted successfully"}
 
+# Campaign delivery helpers
+# Recipients are processed in batches that fill exactly one OneSignal request
+CAMPAIGN_BATCH_SIZE = ONESIGNAL_MAX_EXTERNAL_IDS
+
+def unreached_users_pipeline(campaign_id: str) -> List[dict]:
+    """Aggregation over users selecting those with no delivery record for the campaign"""
+    return [
+        {"$match": {"phone": {"$exists": True, "$ne": ""}}},
+        {"$lookup": {
+            "from": "campaign_deliveries",
+            "let": {"phone": "$phone"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": ["$campaign_id", campaign_id]},
+                    {"$eq": ["$phone", "$$phone"]}
+                ]}}},
+                {"$limit": 1},
+                {"$project": {"_id": 1}}
+            ],
+            "as": "delivered"
+        }},
+        {"$match": {"delivered": {"$size": 0}}},
+        {"$project": {"_id": 0, "id": 1, "phone": 1}}
+    ]
+
+async def record_campaign_deliveries(campaign_id: str, users: List[dict]) -> List[dict]:
+    """Insert a delivery per user and return the users that weren't already reached"""
+    if not users:
+        return []
+    docs = [to_document(CampaignDelivery(campaign_id=campaign_id, phone=user['phone'], user_id=user.get('id'))) for user in users]
+    try:
+        await db.campaign_deliveries.insert_many(docs, ordered=False)
+        return users
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error["code"] != 11000 for error in errors):
+            raise
+        # Duplicate (campaign_id, phone): someone else already delivered to them
+        already_reached = {error["index"] for error in errors}
+        return [user for index, user in enumerate(users) if index not in already_reached]
+
+async def deliver_campaign_batch(campaign: dict, users: List[dict]) -> int:
+    """Record deliveries for a batch of users, queue their pushes and bump the campaign counter"""
+    # Record deliveries first; users another request reached in the meantime are dropped
+    new_recipients = await record_campaign_deliveries(campaign['id'], users)
+    if not new_recipients:
+        return 0
+    
+    # Queue push notifications via OneSignal
+    # إرسال للمستخدمين المحددين
+    payloads = build_push_payloads(campaign['title'], campaign['message'], [user['id'] for user in new_recipients])
+    await enqueue_pushes(payloads, "campaign", campaign['id'])
+    
+    await db.campaigns.update_one({"id": campaign['id']}, {"$inc": {"sent_count": len(new_recipients)}})
+    return len(new_recipients)
+
+async def migrate_campaign_recipients() -> int:
+    """Move legacy sent_to_users arrays into campaign_deliveries"""
+    migrated = 0
+    async for campaign in db.campaigns.find({"sent_to_users": {"$exists": True}}, {"_id": 0, "id": 1, "sent_to_users": 1}):
+        phones = campaign['sent_to_users']
+        for i in range(0, len(phones), 1000):
+            await record_campaign_deliveries(campaign['id'], [{"phone": phone} for phone in phones[i:i + 1000]])
+        delivered = await db.campaign_deliveries.count_documents({"campaign_id": campaign['id']})
+        await db.campaigns.update_one(
+            {"id": campaign['id']},
+            {"$set": {"sent_count": delivered}, "$unset": {"sent_to_users": ""}}
+        )
+        migrated += 1
+    return migrated
+
 # Campaign Routes
 @api_router.post("/campaigns", response_model=Campaign)
 async def create_campaign(campaign: CampaignCreate, created_by: str = "admin"):
     campaign_obj = Campaign(**campaign.model_dump(), created_by=created_by)
-    doc = campaign_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    if doc.get('scheduled_for'):
-        doc['scheduled_for'] = doc['scheduled_for'].isoformat()
+    doc = to_document(campaign_obj)
     await db.campaigns.insert_one(doc)
     return campaign_obj
 
 @api_router.get("/campaigns", response_model=List[Campaign])
-async def get_campaigns():
-    campaigns = await db.campaigns.find({}, {"_id": 0}).to_list(1000)
-    for camp in campaigns:
-        if isinstance(camp['created_at'], str):
-            camp['created_at'] = datetime.fromisoformat(camp['created_at'])
-        if camp.get('scheduled_for') and isinstance(camp['scheduled_for'], str):
-            camp['scheduled_for'] = datetime.fromisoformat(camp['scheduled_for'])
-    return campaigns
+async def get_campaigns(request: Request, response: Response, limit: int = Query(PAGE_SIZE_MAX, ge=1, le=PAGE_SIZE_MAX), after: Optional[str] = None):
+    campaigns = await find_page(db.campaigns, {}, "created_at", ASCENDING, limit, after, response, model_projection(Campaign))
+    return list_response(Campaign, campaigns, request, response)
+
+@api_router.put("/campaigns/{campaign_id}", response_model=Campaign)
+async def update_campaign(campaign_id: str, update: CampaignUpdate):
+    update_data = {k: v for k, v in update.model_dump(exclude={"version"}).items() if v is not None}
+    campaign = await versioned_update(db.campaigns, "Campaign", campaign_id, update.version, update_data)
+    return Campaign(**campaign)
 
 @api_router.post("/campaigns/{campaign_id}/send")
 async def send_campaign(campaign_id: str, max_recipients: Optional[int] = None, background_tasks: BackgroundTasks = None):
@@ -738,88 +2847,51 @@ async def send_campaign(campaign_id: str, max_recipients: Optional[int] = None,
     if not campaign:
         raise HTTPException(status_code=404, detail="Campaign not found")
     
-    # Get all users who have phone numbers (potential recipients)
-    all_users = await db.users.find({"phone": {"$exists": True, "$ne": ""}}, {"_id": 0, "phone": 1}).to_list(100000)
+    # Users with a phone number who haven't received this campaign yet; the
+    # anti-join runs in the database against campaign_deliveries and the
+    # random selection is a $sample stage, so only one batch is held in memory
+    pipeline = unreached_users_pipeline(campaign_id)
+    if max_recipients:
+        pipeline.append({"$sample": {"size": max_recipients}})
+    cursor = db.users.aggregate(pipeline, allowDiskUse=True, batchSize=CAMPAIGN_BATCH_SIZE)
     
-    # Get list of users who already received this campaign
-    previous_recipients = campaign.get('sent_to_users', [])
+    sent = 0
+    batch = []
+    async for user in cursor:
+        batch.append(user)
+        if len(batch) >= CAMPAIGN_BATCH_SIZE:
+            sent += await deliver_campaign_batch(campaign, batch)
+            batch = []
+    if batch:
+        sent += await deliver_campaign_batch(campaign, batch)
     
-    # Filter out users who already received this campaign
-    available_users = [user for user in all_users if user['phone'] not in previous_recipients]
-    
-    # Determine how many users to send to
-    if max_recipients and max_recipients < len(available_users):
-        # Random selection of users
-        import random
-        selected_users = random.sample(available_users, max_recipients)
-    else:
-        # Send to all available users
-        selected_users = available_users
+    if not sent:
+        raise HTTPException(status_code=400, detail="لا يوجد مستخدمون جدد لإرسال الحملة إليهم")
     
-    # Extract phone numbers
-    phone_numbers = [user['phone'] for user in selected_users]
+    campaign = await db.campaigns.find_one_and_update(
+        {"id": campaign_id},
+        {"$set": {"status": "sent", "last_sent_at": datetime.now(timezone.utc)}, "$inc": {"version": 1}},
+        projection={"_id": 0, "sent_count": 1, "broadcast_at": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not campaign.get('broadcast_at'):
+        # The first send also puts the campaign in every patient's in-app feed
+        await db.campaigns.update_one(
+            {"id": campaign_id, "broadcast_at": None},
+            {"$set": {"broadcast_at": datetime.now(timezone.utc)}}
+        )
+        broadcast_cache.clear()
+    total_sent = campaign['sent_count']
     
-    if not phone_numbers:
-        raise HTTPException(status_code=400, detail="لا يوجد مستخدمون جدد لإرسال الحملة إليهم")
+    total_users = await db.users.count_documents({"phone": {"$exists": True, "$ne": ""}})
+    remaining = total_users - total_sent
     
-    # Send push notification via OneSignal
-    try:
-        async with httpx.AsyncClient() as client:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Basic {ONESIGNAL_REST_API_KEY}"
-            }
-            
-            # إرسال للمستخدمين المحددين
-            payload = {
-                "app_id": ONESIGNAL_APP_ID,
-                "included_segments": ["All"],
-                "headings": {"en": campaign['title'], "ar": campaign['title']},
-                "contents": {"en": campaign['message'], "ar": campaign['message']},
-                "url": "https://dental-booking-16.preview.emergentagent.com/patient/dashboard"
-            }
-            
-            response = await client.post(
-                "https://onesignal.com/api/v1/notifications",
-                headers=headers,
-                json=payload,
-                timeout=10.0
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                sent_count = result.get('recipients', 0)
-                print(f"✅ Campaign sent to {sent_count} users")
-                
-                # Update campaign with new recipients
-                updated_recipients = previous_recipients + phone_numbers
-                total_sent = len(updated_recipients)
-                
-                await db.campaigns.update_one(
-                    {"id": campaign_id},
-                    {"$set": {
-                        "status": "sent",
-                        "sent_count": total_sent,
-                        "sent_to_users": updated_recipients,
-                        "last_sent_at": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
-                
-                remaining = len(all_users) - total_sent
-                
-                return {
-                    "message": f"تم إرسال الحملة إلى {len(phone_numbers)} مراجع جديد",
-                    "total_sent_in_campaign": total_sent,
-                    "remaining_users": remaining,
-                    "can_send_more": remaining > 0
-                }
-            else:
-                print(f"❌ Failed to send campaign: {response.text}")
-                raise HTTPException(status_code=500, detail="فشل إرسال الحملة")
-                
-    except Exception as e:
-        print(f"Error sending campaign: {e}")
-        raise HTTPException(status_code=500, detail=f"خطأ في إرسال الحملة: {str(e)}")
+    return {
+        "message": f"تم إرسال الحملة إلى {sent} مراجع جديد",
+        "total_sent_in_campaign": total_sent,
+        "remaining_users": remaining,
+        "can_send_more": remaining > 0
+    }
 
 @api_router.get("/campaigns/{campaign_id}/reach")
 async def get_campaign_reach(campaign_id: str):
@@ -831,9 +2903,8 @@ async def get_campaign_reach(campaign_id: str):
     # Get total registered users
     total_users = await db.users.count_documents({"phone": {"$exists": True, "$ne": ""}})
     
-    # Get users who already received this campaign
-    previous_recipients = campaign.get('sent_to_users', [])
-    sent_count = len(previous_recipients)
+    # Users who already received this campaign
+    sent_count = campaign.get('sent_count', 0)
     
     # Calculate remaining
     remaining = total_users - sent_count
@@ -845,81 +2916,256 @@ async def get_campaign_reach(campaign_id: str):
         "can_send_more": remaining > 0,
         "percentage_reached": round((sent_count / total_users * 100) if total_users > 0 else 0, 1)
     }
-    
-    # Also save to database notifications (backup)
-    users = await db.users.find({"role": "patient"}, {"_id": 0}).to_list(10000)
-    for user in users:
-        await send_notification(
-            user['id'],
-            campaign['title'],
-            campaign['message'],
-            "campaign"
-        )
-    
-    return {"message": f"تم إرسال الحملة بنجاح"}
 
 # Notification Routes
 @api_router.get("/notifications", response_model=List[Notification])
-async def get_notifications(user_id: str):
-    notifications = await db.notifications.find({"user_id": user_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    for notif in notifications:
-        if isinstance(notif['created_at'], str):
-            notif['created_at'] = datetime.fromisoformat(notif['created_at'])
-    return notifications
+async def get_notifications(request: Request, response: Response, user_id: str, limit: int = Query(100, ge=1, le=PAGE_SIZE_MAX), after: Optional[str] = None):
+    """The user's own notifications merged with the campaign broadcasts, newest first"""
+    notifications = await find_page(db.notifications, {"user_id": user_id}, "created_at", DESCENDING, limit, after, response, model_projection(Notification))
+    inbox = await db.notification_counters.find_one({"_id": user_id})
+    broadcasts = user_broadcasts(await campaign_broadcasts(), inbox, user_id)
+    if after:
+        sort_value, last_id = decode_cursor(after)
+        broadcasts = [b for b in broadcasts if (b['created_at'], b['id']) < (sort_value, last_id)]
+    
+    merged = list(heapq.merge(notifications, broadcasts, key=lambda doc: (doc['created_at'], doc['id']), reverse=True))
+    page = merged[:limit]
+    # The next page starts after the last merged row, whichever side it came from
+    if CURSOR_HEADER in response.headers or len(merged) > limit:
+        response.headers[CURSOR_HEADER] = encode_cursor(page[-1], "created_at")
+    return list_response(Notification, page, request, response)
+
+@api_router.get("/notifications/unread-count")
+async def get_unread_count(user_id: str, refresh: bool = False):
+    """
+    Unread notifications of a user, for the app badge (one primary-key read)
+    refresh: Recount from the notifications first
+    """
+    if refresh:
+        await count_unread(user_id)
+    inbox = await db.notification_counters.find_one({"_id": user_id})
+    return {"unread": inbox_unread(inbox, await campaign_broadcasts(), user_id)}
+
+@api_router.post("/notifications/read")
+async def mark_notifications_read(selection: NotificationsRead):
+    """Mark many notifications as read with one update"""
+    before = selection.before
+    if before and before.tzinfo is None:
+        # Stored as UTC either way; aware here so it compares with broadcast_at
+        before = before.replace(tzinfo=timezone.utc)
+    query = {"user_id": selection.user_id, "read": {"$ne": True}}
+    if selection.ids is not None:
+        query["id"] = {"$in": selection.ids}
+    if before:
+        query["created_at"] = {"$lte": before}
+    
+    # Broadcasts in the selection are recorded as read on the user's inbox document.
+    # Worked out before the write, so nothing can fail between it and the counter update.
+    broadcasts = await campaign_broadcasts()
+    read_broadcasts = [
+        broadcast['id'] for broadcast in broadcasts
+        if (selection.ids is None or broadcast['id'] in selection.ids)
+        and (before is None or broadcast['broadcast_at'] <= before)
+    ]
+    
+    result = await db.notifications.update_many(query, {"$set": {"read": True}})
+    update = {}
+    if result.modified_count:
+        update["$inc"] = {"unread": -result.modified_count}
+    if read_broadcasts:
+        update["$addToSet"] = {"broadcasts_read": {"$each": read_broadcasts}}
+    if update:
+        inbox = await db.notification_counters.find_one_and_update(
+            {"_id": selection.user_id}, update, upsert=True, return_document=ReturnDocument.AFTER
+        )
+    else:
+        inbox = await db.notification_counters.find_one({"_id": selection.user_id})
+    return {"marked": result.modified_count, "unread": inbox_unread(inbox, broadcasts, selection.user_id)}
 
 @api_router.put("/notifications/{notification_id}/read")
-async def mark_notification_read(notification_id: str):
-    await db.notifications.update_one({"id": notification_id}, {"$set": {"read": True}})
+async def mark_notification_read(notification_id: str, user_id: Optional[str] = None):
+    """user_id: Needed for campaign broadcasts, which are shared by every user"""
+    # Only an unread -> read transition moves the counter
+    notification = await db.notifications.find_one_and_update(
+        {"id": notification_id, "read": {"$ne": True}},
+        {"$set": {"read": True}},
+        projection={"_id": 0, "user_id": 1}
+    )
+    if notification:
+        await bump_unread({notification['user_id']: -1})
+    elif user_id and any(broadcast['id'] == notification_id for broadcast in await campaign_broadcasts()):
+        await db.notification_counters.update_one(
+            {"_id": user_id}, {"$addToSet": {"broadcasts_read": notification_id}}, upsert=True
+        )
     return {"message": "Notification marked as read"}
 
+@api_router.post("/notifications/{notification_id}/dismiss")
+async def dismiss_notification(notification_id: str, user_id: str):
+    """Remove a notification (or hide a campaign broadcast) from the user's feed"""
+    notification = await db.notifications.find_one_and_delete(
+        {"id": notification_id, "user_id": user_id}, projection={"_id": 0, "read": 1}
+    )
+    if notification:
+        if not notification.get('read'):
+            await bump_unread({user_id: -1})
+    elif any(broadcast['id'] == notification_id for broadcast in await campaign_broadcasts()):
+        await db.notification_counters.update_one(
+            {"_id": user_id}, {"$addToSet": {"broadcasts_dismissed": notification_id}}, upsert=True
+        )
+    else:
+        raise HTTPException(status_code=404, detail="Notification not found")
+    return {"message": "Notification dismissed"}
+
 # Review Routes
 @api_router.post("/reviews", response_model=Review)
 async def create_review(review: ReviewCreate):
     review_obj = Review(**review.model_dump())
-    doc = review_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
+    doc = to_document(review_obj)
     await db.reviews.insert_one(doc)
+    await bump_stats({"rating_sum": doc['rating'], "rating_count": 1})
     return review_obj
 
 @api_router.get("/reviews", response_model=List[Review])
-async def get_reviews(appointment_id: Optional[str] = None):
+async def get_reviews(request: Request, response: Response, appointment_id: Optional[str] = None, limit: int = Query(PAGE_SIZE_MAX, ge=1, le=PAGE_SIZE_MAX), after: Optional[str] = None):
     query = {}
     if appointment_id:
         query["appointment_id"] = appointment_id
-    reviews = await db.reviews.find(query, {"_id": 0}).to_list(1000)
-    for review in reviews:
-        if isinstance(review['created_at'], str):
-            review['created_at'] = datetime.fromisoformat(review['created_at'])
-    return reviews
+    reviews = await find_page(db.reviews, query, "created_at", ASCENDING, limit, after, response, model_projection(Review))
+    return list_response(Review, reviews, request, response)
+
+# Export Routes
+@api_router.get("/export/{collection}")
+async def export_collection(
+    collection: str,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    export_format: ExportFormat = Query(ExportFormat.NDJSON, alias="format"),
+    auth: dict = Depends(require_admin)
+):
+    """
+    Stream every row of appointments, reviews or patients as NDJSON or CSV
+    start/end: Inclusive clinic-local dates on the appointment date (others: creation date)
+    """
+    spec = EXPORTS.get(collection)
+    if not spec:
+        raise HTTPException(status_code=404, detail=f"Unknown export, expected one of: {', '.join(EXPORTS)}")
+    if start and end and end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    
+    query = dict(spec["filter"])
+    date_range = {}
+    if start:
+        date_range["$gte"] = datetime.combine(start, clock_time(0), CLINIC_TIMEZONE)
+    if end:
+        date_range["$lt"] = datetime.combine(end + timedelta(days=1), clock_time(0), CLINIC_TIMEZONE)
+    if date_range:
+        query[spec["date_field"]] = date_range
+    
+    extension = "csv" if export_format == ExportFormat.CSV else "ndjson"
+    media_type = "text/csv; charset=utf-8" if export_format == ExportFormat.CSV else "application/x-ndjson"
+    return StreamingResponse(
+        stream_export(spec, query, export_format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{collection}.{extension}"'}
+    )
 
 # Stats Routes
 @api_router.get("/stats", response_model=Stats)
-async def get_stats():
-    total_appointments = await db.appointments.count_documents({})
-    pending = await db.appointments.count_documents({"status": "pending"})
-    confirmed = await db.appointments.count_documents({"status": "confirmed"})
-    completed = await db.appointments.count_documents({"status": "completed"})
-    cancelled = await db.appointments.count_documents({"status": "cancelled"})
-    total_patients = await db.users.count_documents({"role": "patient"})
-    total_doctors = await db.doctors.count_documents({})
+async def get_stats(refresh: bool = False):
+    """
+    Dashboard stats from the materialized stats document (one primary-key read)
+    refresh: Recompute the counters from the collections first
+    """
+    stats = None if refresh else await db.stats.find_one({"_id": STATS_ID})
+    if not stats:
+        stats = await rebuild_stats()
     
     # Calculate average rating
-    reviews = await db.reviews.find({}, {"_id": 0, "rating": 1}).to_list(10000)
-    avg_rating = sum(r['rating'] for r in reviews) / len(reviews) if reviews else 0
+    avg_rating = stats['rating_sum'] / stats['rating_count'] if stats['rating_count'] else 0
     
     return Stats(
-        total_appointments=total_appointments,
-        pending_appointments=pending,
-        confirmed_appointments=confirmed,
-        completed_appointments=completed,
-        cancelled_appointments=cancelled,
-        total_patients=total_patients,
-        total_doctors=total_doctors,
-        avg_rating=round(avg_rating, 2)
+        total_appointments=stats['total_appointments'],
+        pending_appointments=stats['pending_appointments'],
+        confirmed_appointments=stats['confirmed_appointments'],
+        completed_appointments=stats['completed_appointments'],
+        cancelled_appointments=stats['cancelled_appointments'],
+        total_patients=stats['total_patients'],
+        total_doctors=stats['total_doctors'],
+        avg_rating=round(avg_rating, 2),
+        updated_at=stats['updated_at']
+    )
+
+# Admin Outbox Routes
+@api_router.get("/admin/outbox")
+async def get_outbox_status(auth: dict = Depends(require_admin)):
+    """Outbox depth by status and the most recent dead letters"""
+    counts = {"pending": 0, "in_flight": 0, "sent": 0, "dead": 0}
+    async for row in db.outbox.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+        counts[row["_id"]] = row["count"]
+    
+    dead_letters = await db.outbox.find(
+        {"status": "dead"}, {"_id": 0, "payload": 0}
+    ).sort("next_attempt_at", -1).to_list(50)
+    
+    return {"counts": counts, "dead_letters": dead_letters}
+
+@api_router.post("/admin/outbox/{message_id}/retry")
+async def retry_outbox_message(message_id: str, auth: dict = Depends(require_admin)):
+    """Put a dead-lettered push back in the queue"""
+    result = await db.outbox.update_one(
+        {"id": message_id, "status": "dead"},
+        {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": datetime.now(timezone.utc)}}
     )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Dead-lettered message not found")
+    outbox_workers.notify()
+    return {"message": "Message re-queued"}
+
+# Admin Reminder Routes
+@api_router.get("/admin/reminders/metrics")
+async def get_reminder_metrics(auth: dict = Depends(require_admin)):
+    """Queue depth and firing lag of the reminder engine, and the latest run's throughput"""
+    return {**reminder_engine.metrics(), "last_run": last_reminder_run}
+
+# Admin Catalog Routes
+@api_router.get("/admin/catalog")
+async def get_catalog_cache_status(auth: dict = Depends(require_admin)):
+    """Version and size of this worker's doctor/service cache"""
+    return catalog_cache.metrics()
+
+# Admin Index Routes
+@api_router.get("/admin/indexes")
+async def get_index_report(auth: dict = Depends(require_admin)):
+    """Reconcile the index registry and report created/extra/unused indexes"""
+    return await ensure_indexes()
+
+@api_router.get("/admin/indexes/explain")
+async def explain_route_queries(auth: dict = Depends(require_admin)):
+    """Dump the winning plan of every hot route's query"""
+    results = []
+    for route_query in ROUTE_QUERIES:
+        command = {"find": route_query["collection"], "filter": route_query["filter"]}
+        if route_query.get("sort"):
+            command["sort"] = route_query["sort"]
+        if route_query.get("projection"):
+            command["projection"] = route_query["projection"]
+
+        explain = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        winning_plan = explain["queryPlanner"]["winningPlan"]
+        results.append({
+            "route": route_query["route"],
+            "collection": route_query["collection"],
+            "winning_plan": winning_plan,
+            "collection_scan": bool(find_collection_scans(winning_plan))
+        })
+
+    return {
+        "routes": results,
+        "collection_scans": [r["route"] for r in results if r["collection_scan"]]
+    }
 
 # Include the router in the main app
-app.include_router(api_router)
+app.include_router(api_router, dependencies=[Depends(authenticate)])
 
 app.add_middleware(
     CORSMiddleware,
@@ -927,6 +3173,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[CURSOR_HEADER],
 )
 
 # Configure logging
@@ -938,13 +3185,79 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await availability_index.stop()
+    await catalog_cache.stop()
+    await reminder_engine.stop()
+    await outbox_workers.stop()
     scheduler.shutdown()
+    if onesignal_client:
+        await onesignal_client.aclose()
+    password_executor.shutdown(wait=False)
     client.close()
 
+@app.on_event("startup")
+async def startup_http_client():
+    """Open the shared OneSignal client and start the outbox workers that use it"""
+    global onesignal_client
+    onesignal_client = create_onesignal_client()
+    outbox_workers.start()
+    print(f"✅ Outbox workers started ({outbox_workers.size} workers)")
+
+@app.on_event("startup")
+async def startup_indexes():
+    """Create missing indexes and report extra/unused ones"""
+    report = await ensure_indexes()
+    if report["created"]:
+        print(f"✅ Created indexes: {', '.join(report['created'])}")
+    for failure in report["failed"]:
+        print(f"❌ Failed to create index {failure['index']}: {failure['error']}")
+    if report["extra"]:
+        print(f"⚠️ Indexes not in registry: {', '.join(report['extra'])}")
+    
+    # Resync the materialized counters in case a write was missed
+    await rebuild_stats()
+    
+    # Normally already done with `python server.py migrate-dates`; a no-op once finished
+    converted = await migrate_iso_dates()
+    if any(converted.values()):
+        print(f"✅ Converted ISO-string dates to native dates: {converted}")
+    
+    migrated = await migrate_campaign_recipients()
+    if migrated:
+        print(f"✅ Moved recipients of {migrated} campaigns to campaign_deliveries")
+    
+    counted = await backfill_notification_counters()
+    if counted:
+        print(f"✅ Counted unread notifications of {counted} users")
+
+@app.on_event("startup")
+async def startup_catalog_cache():
+    """Load the doctor and service catalogs and start watching their version stamp"""
+    await catalog_cache.load()
+    catalog_cache.start()
+    metrics = catalog_cache.metrics()
+    print(f"✅ Catalog cache loaded ({metrics['doctors']} doctors, {metrics['services']} services)")
+    
+    # Both need the service durations from the catalog
+    backfill = await backfill_reservations()
+    if backfill["reserved"]:
+        print(f"✅ Reserved {backfill['reserved']} slots of existing appointments")
+    if backfill["conflicts"]:
+        print(f"⚠️ {backfill['conflicts']} slots are double-booked by existing appointments")
+    
+    await availability_index.rebuild()
+    availability_index.start()
+    print(f"✅ Availability index loaded ({availability_index.metrics()['bookings']} upcoming bookings)")
+
 @app.on_event("startup")
 async def startup_scheduler():
-    """Start the automatic reminder scheduler"""
-    # Run reminder check every 30 minutes
+    """Start the reminder engine and the backstop reminder sweep"""
+    # Load upcoming reminders; ones missed while we were down fire right away
+    await reminder_engine.rebuild()
+    reminder_engine.start()
+    print(f"✅ Reminder engine started ({reminder_engine.metrics()['queue_depth']} appointments queued)")
+    
+    # Sweep every 30 minutes for reminders the engine didn't see (other workers)
     scheduler.add_job(
         send_automatic_reminders,
         'interval',
@@ -953,4 +3266,19 @@ async def startup_scheduler():
         replace_existing=True
     )
     scheduler.start()
-    print("✅ Automatic reminder scheduler started (checks every 30 minutes)")
\ No newline at end of file
+    print("✅ Backstop reminder sweep started (checks every 30 minutes)")
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Alghasab Dental Clinic backend maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate-dates", help="Rewrite ISO-string dates as native BSON dates (resumable)")
+    migrate_parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE)
+    args = parser.parse_args()
+    
+    if args.command == "migrate-dates":
+        converted = asyncio.run(migrate_iso_dates(args.batch_size))
+        for collection_name, count in converted.items():
+            print(f"✅ {collection_name}: converted {count} documents")
+        print("✅ Date migration complete")
@@ -0,0 +1,662 @@
+#!/usr/bin/env python3
+"""
+Backend Benchmarks for Alghasab Dental Clinic
+Micro-benchmarks for the backend hot paths, run against local fakes
+
+Usage: python backend_benchmark.py <benchmark> [options]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# server.py reads these at import time; nothing connects until a query runs
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "alghasab_benchmark")
+os.environ.setdefault("ONESIGNAL_REST_API_KEY", "benchmark-key")
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+
+def print_latencies(label, samples_ms):
+    """Print mean/p50/p99 of a list of latencies in milliseconds"""
+    samples_ms = sorted(samples_ms)
+    p99 = samples_ms[min(len(samples_ms) - 1, int(len(samples_ms) * 0.99))]
+    print(f"{label:<28} mean {statistics.mean(samples_ms):8.2f} ms   "
+          f"p50 {statistics.median(samples_ms):8.2f} ms   p99 {p99:8.2f} ms")
+
+
+def bench_request(accept="application/json"):
+    """A bare GET request with the given Accept header, for calling route functions directly"""
+    from starlette.requests import Request
+    return Request({"type": "http", "method": "GET", "path": "/", "query_string": b"",
+                    "headers": [(b"accept", accept.encode())]})
+
+
+# ---------------------------------------------------------------------------
+# OneSignal client
+# ---------------------------------------------------------------------------
+
+async def start_fake_onesignal(port, handshake_ms):
+    """
+    Minimal HTTP/1.1 server answering like OneSignal's notifications API.
+    The first request on every connection is delayed by handshake_ms to
+    stand in for the TCP+TLS setup a real connection to onesignal.com costs.
+    """
+    body = json.dumps({"id": "fake-notification", "recipients": 1}).encode()
+    response = (
+        b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+        b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+    )
+
+    async def handle(reader, writer):
+        first = True
+        try:
+            while True:
+                headers = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in headers.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                await reader.readexactly(length)
+                if first:
+                    await asyncio.sleep(handshake_ms / 1000)
+                    first = False
+                writer.write(response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", port)
+
+
+async def bench_onesignal(args):
+    """Per-push latency: a fresh httpx client per call vs the shared pooled client"""
+    import httpx
+
+    url = f"http://127.0.0.1:{args.port}/api/v1/notifications"
+    os.environ["ONESIGNAL_API_URL"] = url
+    import server
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Basic {server.ONESIGNAL_REST_API_KEY}"
+    }
+    payload = {
+        "app_id": server.ONESIGNAL_APP_ID,
+        "included_segments": ["All"],
+        "headings": {"en": "benchmark", "ar": "benchmark"},
+        "contents": {"en": "benchmark", "ar": "benchmark"},
+    }
+    fake = await start_fake_onesignal(args.port, args.handshake_ms)
+
+    # Before: what every push path did, a new client (and connection) per call
+    before = []
+    for _ in range(args.pushes):
+        start = time.perf_counter()
+        async with httpx.AsyncClient() as client:
+            await client.post(url, headers=headers, json=payload, timeout=10.0)
+        before.append((time.perf_counter() - start) * 1000)
+
+    # After: the application-lifetime client
+    server.onesignal_client = server.create_onesignal_client()
+    after = []
+    for _ in range(args.pushes):
+        start = time.perf_counter()
+        await server.post_onesignal(payload)
+        after.append((time.perf_counter() - start) * 1000)
+    await server.onesignal_client.aclose()
+
+    fake.close()
+    await fake.wait_closed()
+
+    print(f"{args.pushes} pushes, simulated connection setup {args.handshake_ms} ms")
+    print_latencies("client per push (before)", before)
+    print_latencies("shared client (after)", after)
+
+
+def add_onesignal_arguments(parser):
+    parser.add_argument("--pushes", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--handshake-ms", type=float, default=50.0)
+
+
+# ---------------------------------------------------------------------------
+# Campaign audience selection (needs MongoDB at MONGO_URL)
+# ---------------------------------------------------------------------------
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def seed_users(db, size):
+    """Make the users collection hold exactly `size` patients with phones"""
+    count = await db.users.count_documents({})
+    if count > size:
+        await db.users.delete_many({})
+        count = 0
+    batch = []
+    for i in range(count, size):
+        batch.append({"id": f"bench-user-{i}", "phone": f"+9665{i:08d}", "role": "patient"})
+        if len(batch) == 10000:
+            await db.users.insert_many(batch)
+            batch = []
+    if batch:
+        await db.users.insert_many(batch)
+
+
+async def audience_run(args):
+    """One measured send in a fresh process, so ru_maxrss is this run's peak"""
+    import random
+    import server
+
+    db = server.db
+    await db.campaign_deliveries.delete_many({"campaign_id": "bench-campaign"})
+    await db.outbox.delete_many({"reference": "bench-campaign"})
+    await db.campaigns.replace_one(
+        {"id": "bench-campaign"},
+        {"id": "bench-campaign", "title": "bench", "message": "bench", "target_audience": "all",
+         "sent_count": 0, "status": "draft", "created_by": "benchmark", "created_at": datetime(2025, 1, 1, tzinfo=timezone.utc)},
+        upsert=True
+    )
+    baseline_mb = peak_rss_mb()
+    max_recipients = args.max_recipients or None
+
+    start = time.perf_counter()
+    if args.variant == "materialize":
+        # Before: every user document in a Python list, then random.sample over it
+        users = await db.users.find({"phone": {"$exists": True, "$ne": ""}}, {"_id": 0, "id": 1, "phone": 1}).to_list(None)
+        if max_recipients and max_recipients < len(users):
+            users = random.sample(users, max_recipients)
+        sent = len(users)
+    else:
+        result = await server.send_campaign("bench-campaign", max_recipients)
+        sent = result["total_sent_in_campaign"]
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({"sent": sent, "seconds": elapsed, "peak_rss_mb": peak_rss_mb(), "baseline_rss_mb": baseline_mb}))
+
+
+async def bench_campaign_audience(args):
+    """Peak RSS and wall time of campaign audience selection at several audience sizes"""
+    if args.variant:
+        await audience_run(args)
+        return
+
+    import server
+
+    print(f"{'users':>10} {'variant':>12} {'sent':>10} {'seconds':>9} {'peak RSS MB':>12}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        await seed_users(server.db, size)
+        for variant in ("materialize", "stream"):
+            output = subprocess.run(
+                [sys.executable, __file__, "campaign-audience", "--variant", variant,
+                 "--max-recipients", str(args.max_recipients)],
+                capture_output=True, text=True, check=True
+            ).stdout.strip().splitlines()[-1]
+            result = json.loads(output)
+            print(f"{size:>10} {variant:>12} {result['sent']:>10} {result['seconds']:>9.2f} {result['peak_rss_mb']:>12.1f}")
+
+
+def add_campaign_audience_arguments(parser):
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--max-recipients", type=int, default=0, help="0 = send to everyone")
+    parser.add_argument("--variant", choices=["materialize", "stream"], help=argparse.SUPPRESS)
+
+
+# ---------------------------------------------------------------------------
+# List endpoint dates (needs MongoDB at MONGO_URL)
+# ---------------------------------------------------------------------------
+
+def bench_appointment(i, native):
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    appointment_date = start + timedelta(minutes=30 * i)
+    created_at = start + timedelta(seconds=i)
+    return {
+        "id": f"bench-apt-{i:07d}", "patient_id": "", "patient_name": "Bench", "patient_phone": f"+9665{i:08d}",
+        "doctor_id": "bench-doctor", "doctor_name": "Bench", "service_id": "bench-service", "service_name": "Bench",
+        "appointment_date": appointment_date if native else appointment_date.isoformat(),
+        "status": "pending", "created_by": "benchmark",
+        "created_at": created_at if native else created_at.isoformat(),
+    }
+
+
+async def bench_list_dates(args):
+    """GET /api/appointments page latency: ISO-string dates parsed per row (before) vs native BSON dates (after)"""
+    from fastapi import Response
+    from pydantic import TypeAdapter
+    import server
+
+    db = server.db
+    validate = TypeAdapter(server.List[server.Appointment]).validate_python
+    for name, native in (("appointments", True), ("bench_appointments_iso", False)):
+        await db[name].delete_many({})
+        for offset in range(0, args.rows, 10000):
+            await db[name].insert_many([bench_appointment(i, native) for i in range(offset, min(offset + 10000, args.rows))])
+        await db[name].create_index([("appointment_date", -1), ("id", -1)])
+
+    async def before():
+        # The route as it was: string dates, parsed with fromisoformat on every row
+        appointments = await db.bench_appointments_iso.find({}, {"_id": 0}).sort(
+            [("appointment_date", -1), ("id", -1)]).limit(args.limit + 1).to_list(args.limit + 1)
+        for apt in appointments:
+            if isinstance(apt['appointment_date'], str):
+                apt['appointment_date'] = datetime.fromisoformat(apt['appointment_date'])
+            if isinstance(apt['created_at'], str):
+                apt['created_at'] = datetime.fromisoformat(apt['created_at'])
+        return validate(appointments[:args.limit])
+
+    async def after():
+        return validate(await server.get_appointments(bench_request(), Response(), limit=args.limit, after=None))
+
+    print(f"{args.rows} appointments, page of {args.limit}, {args.requests} requests")
+    for label, fetch in (("ISO strings (before)", before), ("native dates (after)", after)):
+        await fetch()  # warm up
+        samples = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            await fetch()
+            samples.append((time.perf_counter() - start) * 1000)
+        print_latencies(label, samples)
+
+
+def add_list_dates_arguments(parser):
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=50)
+
+
+# ---------------------------------------------------------------------------
+# List response serialization (in process, no database)
+# ---------------------------------------------------------------------------
+
+async def bench_list_serialize(args):
+    """Microseconds per row to turn GET /api/appointments rows into a JSON body, default vs FAST_RESPONSES"""
+    from fastapi import Response
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    import server
+
+    route = next(route for route in server.app.routes
+                 if getattr(route, "path", None) == "/api/appointments" and "GET" in route.methods)
+
+    print(f"{'rows':>8} {'default us/row':>15} {'fast us/row':>12} {'speedup':>8}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        rows = [bench_appointment(i, native=True) for i in range(size)]
+
+        async def fetch_page(*_args, **_kwargs):
+            return rows
+        server.find_page = fetch_page
+
+        async def default():
+            # What FastAPI does with a plain list: validate against response_model, then json.dumps
+            server.FAST_RESPONSES = False
+            content = await server.get_appointments(bench_request(), Response(), limit=size, after=None)
+            return JSONResponse(await serialize_response(field=route.response_field, response_content=content)).body
+
+        async def fast():
+            server.FAST_RESPONSES = True
+            return (await server.get_appointments(bench_request(), Response(), limit=size, after=None)).body
+
+        timings = {}
+        for label, render in (("default", default), ("fast", fast)):
+            await render()  # warm up
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                await render()
+            timings[label] = (time.perf_counter() - start) / args.repeat / size * 1e6
+        print(f"{size:>8} {timings['default']:>15.2f} {timings['fast']:>12.2f} {timings['default'] / timings['fast']:>7.1f}x")
+
+
+def add_list_serialize_arguments(parser):
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--repeat", type=int, default=3)
+
+
+# ---------------------------------------------------------------------------
+# Wire format: JSON vs MessagePack (in process, no database)
+# ---------------------------------------------------------------------------
+
+def bench_notification(i):
+    return {
+        "id": f"bench-notification-{i:07d}", "user_id": "bench-user", "title": "تذكير بموعدك",
+        "message": "موعدك غداً مع د. أحمد الساعة 10:00 صباحاً", "type": "reminder",
+        "appointment_id": f"bench-apt-{i:07d}", "read": i % 3 == 0,
+        "created_at": datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=i),
+    }
+
+
+def bench_appointment_row(i):
+    return bench_appointment(i, native=True)
+
+
+async def bench_wire_format(args):
+    """Body size and encode/decode time per list endpoint, JSON (default) vs Accept: application/msgpack"""
+    import gzip
+    from fastapi import Response
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    import msgpack
+    import server
+
+    endpoints = {
+        "/api/appointments": (server.get_appointments, {}, bench_appointment_row),
+        "/api/notifications": (server.get_notifications, {"user_id": "bench-user"}, bench_notification),
+    }
+    routes = {route.path: route for route in server.app.routes if "GET" in getattr(route, "methods", ())}
+
+    print(f"{args.rows} rows per page, {args.repeat} requests")
+    print(f"{'endpoint':<20} {'format':<8} {'bytes':>10} {'gzip':>10} {'encode ms':>10} {'decode ms':>10}")
+    for path, (route_function, params, make_row) in endpoints.items():
+        rows = [make_row(i) for i in range(args.rows)]
+
+        async def fetch_page(*_args, **_kwargs):
+            return rows
+        server.find_page = fetch_page
+
+        async def as_json():
+            content = await route_function(bench_request(), Response(), limit=args.rows, after=None, **params)
+            return JSONResponse(await serialize_response(field=routes[path].response_field, response_content=content)).body
+
+        async def as_msgpack():
+            return (await route_function(bench_request(server.MSGPACK_MEDIA_TYPE), Response(), limit=args.rows, after=None, **params)).body
+
+        for label, render, decode in (("json", as_json, json.loads),
+                                      ("msgpack", as_msgpack, lambda body: msgpack.unpackb(body, timestamp=3))):
+            body = await render()
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                await render()
+            encode_ms = (time.perf_counter() - start) / args.repeat * 1000
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                decode(body)
+            decode_ms = (time.perf_counter() - start) / args.repeat * 1000
+            print(f"{path:<20} {label:<8} {len(body):>10} {len(gzip.compress(body)):>10} {encode_ms:>10.2f} {decode_ms:>10.2f}")
+
+
+def add_wire_format_arguments(parser):
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+
+
+# ---------------------------------------------------------------------------
+# Admin login load (needs MongoDB at MONGO_URL)
+# ---------------------------------------------------------------------------
+
+async def bench_admin_login(args):
+    """p99 of GET /api/appointments while admins log in concurrently, bcrypt on the event loop vs on the password pool"""
+    import httpx
+    import server
+
+    db = server.db
+    await db.admin_users.replace_one(
+        {"username": "bench-admin"},
+        {"id": "bench-admin", "username": "bench-admin", "name": "Bench", "role": "admin",
+         "password_hash": server.pwd_context.hash("bench-password")},
+        upsert=True
+    )
+    if not await db.appointments.count_documents({}):
+        await db.appointments.insert_many([bench_appointment(i, native=True) for i in range(args.limit)])
+
+    offloaded = server.run_password_hash
+
+    async def on_event_loop(function, *function_args):
+        # The old behaviour: passlib called directly from the coroutine
+        return function(*function_args)
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        async def probe_request(scheduled_at):
+            response = await client.get("/api/appointments", params={"limit": args.limit})
+            response.raise_for_status()
+            return (time.perf_counter() - scheduled_at) * 1000
+
+        async def probe(stop):
+            # Open loop: latency counts from when each request was due, so time the
+            # event loop spent frozen shows up instead of just delaying the next probe
+            requests = []
+            due_at = time.perf_counter()
+            while not stop.is_set():
+                requests.append(asyncio.create_task(probe_request(due_at)))
+                due_at += args.probe_interval_ms / 1000
+                await asyncio.sleep(max(0, due_at - time.perf_counter()))
+            return await asyncio.gather(*requests)
+
+        async def logins():
+            for _ in range(args.logins_per_admin):
+                response = await client.post("/api/auth/admin/login",
+                                             json={"username": "bench-admin", "password": "bench-password"})
+                assert response.status_code in (200, 503), response.text
+
+        print(f"{args.admins} admins x {args.logins_per_admin} logins, probe every {args.probe_interval_ms} ms")
+        for label, hasher in (("idle", None), ("bcrypt on event loop", on_event_loop), ("bcrypt on pool", offloaded)):
+            stop = asyncio.Event()
+            probe_task = asyncio.create_task(probe(stop))
+            if hasher:
+                server.run_password_hash = hasher
+                await asyncio.gather(*(logins() for _ in range(args.admins)))
+            else:
+                await asyncio.sleep(args.idle_seconds)
+            stop.set()
+            print_latencies(label, await probe_task)
+    server.run_password_hash = offloaded
+
+
+def add_admin_login_arguments(parser):
+    parser.add_argument("--admins", type=int, default=8)
+    parser.add_argument("--logins-per-admin", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=50, help="appointments per probe page")
+    parser.add_argument("--probe-interval-ms", type=float, default=20.0)
+    parser.add_argument("--idle-seconds", type=float, default=3.0)
+
+
+# ---------------------------------------------------------------------------
+# Availability (in process, no database)
+# ---------------------------------------------------------------------------
+
+async def bench_availability(args):
+    """Time to compute a month of free slots for every doctor from the availability index"""
+    import random
+    import server
+
+    doctors = [{"id": f"bench-doctor-{i}", "name": f"Doctor {i}", "specialization": "general",
+                "available_days": ["sunday", "monday", "tuesday", "wednesday", "thursday"],
+                "created_at": datetime(2025, 1, 1, tzinfo=timezone.utc)} for i in range(args.doctors)]
+    services = [{"id": f"bench-service-{minutes}", "name": "bench", "name_en": "bench", "duration_minutes": minutes,
+                 "created_at": datetime(2025, 1, 1, tzinfo=timezone.utc)} for minutes in (15, 30, 45, 60)]
+    server.catalog_cache._ordered = {"doctors": doctors, "services": services}
+    server.catalog_cache._by_id = {name: {doc["id"]: doc for doc in docs} for name, docs in server.catalog_cache._ordered.items()}
+
+    first_day = datetime.now(server.CLINIC_TIMEZONE).date() + timedelta(days=1)
+    last_day = first_day + timedelta(days=args.days - 1)
+    rng = random.Random(1)
+    for i in range(args.bookings):
+        day = first_day + timedelta(days=rng.randrange(args.days))
+        shift_start, _ = rng.choice(server.CLINIC_SHIFTS)
+        start = datetime.combine(day, shift_start, server.CLINIC_TIMEZONE) + timedelta(minutes=15 * rng.randrange(12))
+        server.availability_index.upsert({
+            "id": f"bench-apt-{i}", "doctor_id": rng.choice(doctors)["id"], "service_id": rng.choice(services)["id"],
+            "appointment_date": start.astimezone(timezone.utc), "status": "confirmed",
+        })
+
+    samples = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = await server.get_availability(start=first_day, end=last_day, service_id="bench-service-30")
+        samples.append((time.perf_counter() - start) * 1000)
+    slots = sum(len(day.slots) for doctor in result for day in doctor.days)
+    print(f"{args.doctors} doctors, {args.days} days, {args.bookings} bookings -> {slots} free slots")
+    print_latencies("all doctors, one month", samples)
+
+
+def add_availability_arguments(parser):
+    parser.add_argument("--doctors", type=int, default=10)
+    parser.add_argument("--days", type=int, default=31)
+    parser.add_argument("--bookings", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=50)
+
+
+# ---------------------------------------------------------------------------
+# Double booking (needs MongoDB at MONGO_URL)
+# ---------------------------------------------------------------------------
+
+async def bench_double_booking(args):
+    """Concurrent POST /api/appointments for one doctor and slot; exactly one may succeed"""
+    import httpx
+    import server
+
+    db = server.db
+    await db.reservations.create_indexes(server.INDEX_REGISTRY["reservations"])
+    created_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    doctor = {"id": "bench-doctor", "name": "Bench", "specialization": "general", "available_days": [],
+              "created_at": created_at}
+    service = {"id": "bench-service-60", "name": "bench", "name_en": "bench", "duration_minutes": 60,
+               "created_at": created_at}
+    await db.doctors.replace_one({"id": doctor["id"]}, doctor, upsert=True)
+    await db.services.replace_one({"id": service["id"]}, service, upsert=True)
+    await server.catalog_cache.load()
+
+    slot = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) + timedelta(days=30)
+    await db.appointments.delete_many({"doctor_id": doctor["id"]})
+    await db.reservations.delete_many({"doctor_id": doctor["id"]})
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        async def book(i):
+            # Half of the requests overlap the slot part way through instead of starting on it
+            start = slot + timedelta(minutes=15 * (i % 4) if i % 2 else 0)
+            response = await client.post("/api/appointments", json={
+                "patient_name": f"Patient {i}", "patient_phone": f"05{i:08d}", "doctor_id": doctor["id"],
+                "service_id": service["id"], "appointment_date": start.isoformat(),
+            })
+            return response.status_code
+
+        start = time.perf_counter()
+        statuses = await asyncio.gather(*(book(i) for i in range(args.bookings)))
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+    counts = {status: statuses.count(status) for status in sorted(set(statuses))}
+    booked = await db.appointments.count_documents({"doctor_id": doctor["id"]})
+    print(f"{args.bookings} concurrent bookings in {elapsed_ms:.0f} ms: {counts}, {booked} appointment(s) stored")
+    if counts.get(200) != 1 or booked != 1 or set(counts) - {200, 409}:
+        raise SystemExit("❌ double booking: expected exactly one 200 and the rest 409")
+    print("✅ exactly one booking won the slot")
+
+
+def add_double_booking_arguments(parser):
+    parser.add_argument("--bookings", type=int, default=500)
+
+
+# ---------------------------------------------------------------------------
+# Bulk appointments (needs MongoDB at MONGO_URL)
+# ---------------------------------------------------------------------------
+
+async def bench_bulk_appointments(args):
+    """N individual POST/PUT /api/appointments calls vs one POST /api/appointments/bulk of N items"""
+    import httpx
+    import server
+
+    db = server.db
+    await db.reservations.create_indexes(server.INDEX_REGISTRY["reservations"])
+    created_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    doctor = {"id": "bench-doctor", "name": "Bench", "specialization": "general", "available_days": [],
+              "created_at": created_at}
+    service = {"id": "bench-service-15", "name": "bench", "name_en": "bench", "duration_minutes": 15,
+               "created_at": created_at}
+    await db.doctors.replace_one({"id": doctor["id"]}, doctor, upsert=True)
+    await db.services.replace_one({"id": service["id"]}, service, upsert=True)
+    await db.admin_users.replace_one({"id": "bench-admin"}, {"id": "bench-admin", "username": "bench-admin",
+                                                             "name": "Bench", "role": "admin"}, upsert=True)
+    await server.catalog_cache.load()
+    headers = {"Authorization": f"Bearer {server.create_access_token({'user_id': 'bench-admin', 'role': 'admin'})}"}
+
+    first_slot = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) + timedelta(days=30)
+    bookings = [{"patient_id": f"bench-patient-{i}", "patient_name": f"Patient {i}", "patient_phone": f"05{i:08d}",
+                 "doctor_id": doctor["id"], "service_id": service["id"],
+                 "appointment_date": (first_slot + timedelta(minutes=15 * i)).isoformat()}
+                for i in range(args.items)]
+
+    async def reset():
+        await db.appointments.delete_many({"doctor_id": doctor["id"]})
+        await db.reservations.delete_many({"doctor_id": doctor["id"]})
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", headers=headers) as client:
+        async def individual():
+            ids = []
+            for booking in bookings:
+                response = await client.post("/api/appointments", json=booking)
+                response.raise_for_status()
+                ids.append(response.json()["id"])
+            create_ms = (time.perf_counter() - start) * 1000
+            for appointment_id in ids:
+                response = await client.put(f"/api/appointments/{appointment_id}", json={"status": "confirmed"})
+                response.raise_for_status()
+            return create_ms
+
+        async def bulk():
+            response = await client.post("/api/appointments/bulk",
+                                         json={"operations": [{"create": booking} for booking in bookings]})
+            response.raise_for_status()
+            ids = [result["appointment"]["id"] for result in response.json()]
+            assert len(ids) == args.items, response.text
+            create_ms = (time.perf_counter() - start) * 1000
+            response = await client.post("/api/appointments/bulk", json={"operations": [
+                {"appointment_id": appointment_id, "update": {"status": "confirmed"}} for appointment_id in ids
+            ]})
+            response.raise_for_status()
+            assert all(result["status_code"] == 200 for result in response.json()), response.text
+            return create_ms
+
+        print(f"{args.items} creates, then {args.items} confirmations")
+        for label, run in (("individual calls", individual), ("one bulk call each", bulk)):
+            await reset()
+            start = time.perf_counter()
+            create_ms = await run()
+            total_ms = (time.perf_counter() - start) * 1000
+            print(f"{label:<20} create {create_ms:9.1f} ms   confirm {total_ms - create_ms:9.1f} ms   total {total_ms:9.1f} ms")
+    await reset()
+
+
+def add_bulk_appointments_arguments(parser):
+    parser.add_argument("--items", type=int, default=500)
+
+
+BENCHMARKS = {
+    "onesignal": (bench_onesignal, add_onesignal_arguments),
+    "campaign-audience": (bench_campaign_audience, add_campaign_audience_arguments),
+    "list-dates": (bench_list_dates, add_list_dates_arguments),
+    "list-serialize": (bench_list_serialize, add_list_serialize_arguments),
+    "wire-format": (bench_wire_format, add_wire_format_arguments),
+    "admin-login": (bench_admin_login, add_admin_login_arguments),
+    "availability": (bench_availability, add_availability_arguments),
+    "double-booking": (bench_double_booking, add_double_booking_arguments),
+    "bulk-appointments": (bench_bulk_appointments, add_bulk_appointments_arguments),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    for name, (bench, add_arguments) in BENCHMARKS.items():
+        add_arguments(subparsers.add_parser(name, help=bench.__doc__))
+
+    args = parser.parse_args()
+    asyncio.run(BENCHMARKS[args.benchmark][0](args))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ import { BrowserRouter, Routes, Route, Navigate } from 'react-router-dom';
 import '@/App.css';
 import { Toaster } from '@/components/ui/sonner';
 import { toast } from 'sonner';
+import axios from 'axios';
+import { unlinkPushDevice } from '@/onesignal';
 
 // Pages
 import LandingPage from '@/pages/LandingPage';
@@ -13,6 +15,15 @@ import AdminDashboard from '@/pages/AdminDashboard';
 import BeforeTreatmentInstructions from '@/pages/BeforeTreatmentInstructions';
 import AfterTreatmentInstructions from '@/pages/AfterTreatmentInstructions';
 
+// Send the session token with every API request
+const setAuthToken = (token) => {
+  if (token) {
+    axios.defaults.headers.common['Authorization'] = `Bearer ${token}`;
+  } else {
+    delete axios.defaults.headers.common['Authorization'];
+  }
+};
+
 function App() {
   const [user, setUser] = useState(null);
   const [loading, setLoading] = useState(true);
@@ -22,6 +33,7 @@ function App() {
     const token = localStorage.getItem('token');
     const userData = localStorage.getItem('user');
     if (token && userData) {
+      setAuthToken(token);
       setUser(JSON.parse(userData));
     }
     setLoading(false);
@@ -29,12 +41,15 @@ function App() {
 
   const handleLogin = (userData, token) => {
     setUser(userData);
+    setAuthToken(token);
     localStorage.setItem('token', token);
     localStorage.setItem('user', JSON.stringify(userData));
   };
 
   const handleLogout = () => {
+    unlinkPushDevice();
     setUser(null);
+    setAuthToken(null);
     localStorage.removeItem('token');
     localStorage.removeItem('user');
     toast.success('تم تسجيل الخروج بنجاح');
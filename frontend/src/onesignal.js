@@ -0,0 +1,87 @@
+// OneSignal web push
+// The backend addresses pushes to the patient's user id (OneSignal external id),
+// so every device has to be logged in to OneSignal as that user to receive them.
+import { Capacitor } from '@capacitor/core';
+import axios from 'axios';
+
+const ONESIGNAL_APP_ID = '3adbb1be-a764-4977-a22c-0de12043ac2e';
+const ONESIGNAL_SDK_URL = 'https://cdn.onesignal.com/sdks/web/v16/OneSignalSDK.page.js';
+const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
+
+let oneSignalReady;
+
+// Report the device's subscription id so the backend links it to the user as well
+const reportSubscription = async (subscriptionId) => {
+  if (!subscriptionId) return;
+  try {
+    await axios.put(`${API}/users/me`, null, { params: { fcm_token: subscriptionId } });
+  } catch (error) {
+    console.error('Error registering push device:', error);
+  }
+};
+
+// Load and initialise the SDK once; resolves to null where web push isn't available
+const loadOneSignal = () => {
+  if (oneSignalReady) return oneSignalReady;
+  if (Capacitor.isNativePlatform() || !('Notification' in window)) {
+    oneSignalReady = Promise.resolve(null);
+    return oneSignalReady;
+  }
+  oneSignalReady = new Promise((resolve) => {
+    window.OneSignalDeferred = window.OneSignalDeferred || [];
+    window.OneSignalDeferred.push(async (OneSignal) => {
+      try {
+        await OneSignal.init({ appId: ONESIGNAL_APP_ID, serviceWorkerPath: 'OneSignalSDKWorker.js' });
+        // The subscription id only exists once permission is granted
+        OneSignal.User.PushSubscription.addEventListener('change', (event) => {
+          reportSubscription(event.current.id);
+        });
+        resolve(OneSignal);
+      } catch (error) {
+        console.log('OneSignal not initialized:', error);
+        resolve(null);
+      }
+    });
+    const script = document.createElement('script');
+    script.src = ONESIGNAL_SDK_URL;
+    script.defer = true;
+    script.onerror = () => resolve(null);
+    document.head.appendChild(script);
+  });
+  return oneSignalReady;
+};
+
+// Log this device in as the patient; returns whether pushes are allowed, or null if unsupported
+export const linkPushDevice = async (user) => {
+  const OneSignal = await loadOneSignal();
+  if (!OneSignal) return null;
+  try {
+    await OneSignal.login(user.id);
+    await reportSubscription(OneSignal.User.PushSubscription.id);
+    return OneSignal.Notifications.permission;
+  } catch (error) {
+    console.error('Error linking push device:', error);
+    return null;
+  }
+};
+
+// Ask for permission, then link the new subscription to the patient
+export const requestPushPermission = async (user) => {
+  const OneSignal = await loadOneSignal();
+  if (!OneSignal) return null;
+  try {
+    await OneSignal.Notifications.requestPermission();
+  } catch (error) {
+    console.error('Error getting notification permission:', error);
+  }
+  return linkPushDevice(user);
+};
+
+// Detach the device on logout so it stops receiving the previous patient's pushes
+export const unlinkPushDevice = async () => {
+  if (!oneSignalReady) return;
+  const OneSignal = await oneSignalReady;
+  if (OneSignal) {
+    await OneSignal.logout();
+  }
+};
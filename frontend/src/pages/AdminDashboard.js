@@ -235,13 +235,19 @@ const AppointmentsTable = ({ appointments, onUpdate }) => {
     appointment_time: ''
   });
   
-  const handleStatusChange = async (id, status) => {
+  const handleStatusChange = async (apt, status) => {
     try {
-      await axios.put(`${API}/appointments/${id}`, { status });
+      await axios.put(`${API}/appointments/${apt.id}`, { status, version: apt.version });
       toast.success('تم تحديث حالة الموعد');
       onUpdate();
     } catch (error) {
-      toast.error('خطأ في تحديث حالة الموعد');
+      if (error.response?.status === 409) {
+        // Someone else changed it first; show their version
+        toast.error(error.response.data.detail);
+        onUpdate();
+      } else {
+        toast.error('خطأ في تحديث حالة الموعد');
+      }
     }
   };
 
@@ -258,13 +264,20 @@ const AppointmentsTable = ({ appointments, onUpdate }) => {
     try {
       const dateTime = new Date(`${editForm.appointment_date}T${editForm.appointment_time}`);
       await axios.put(`${API}/appointments/${editingAppointment.id}`, {
-        appointment_date: dateTime.toISOString()
+        appointment_date: dateTime.toISOString(),
+        version: editingAppointment.version
       });
       toast.success('تم تحديث الموعد بنجاح');
       setEditingAppointment(null);
       onUpdate();
     } catch (error) {
-      toast.error('خطأ في تحديث الموعد');
+      if (error.response?.status === 409) {
+        toast.error(error.response.data.detail);
+        setEditingAppointment(null);
+        onUpdate();
+      } else {
+        toast.error('خطأ في تحديث الموعد');
+      }
     }
   };
 
@@ -331,7 +344,7 @@ const AppointmentsTable = ({ appointments, onUpdate }) => {
                   )}
                 </td>
                 <td className="px-6 py-4">
-                  <Select value={apt.status} onValueChange={(value) => handleStatusChange(apt.id, value)}>
+                  <Select value={apt.status} onValueChange={(value) => handleStatusChange(apt, value)}>
                     <SelectTrigger className={`w-32 ${statusColors[apt.status]}`}>
                       <SelectValue />
                     </SelectTrigger>
@@ -12,6 +12,7 @@ import axios from 'axios';
 import { Calendar, Bell, Clock, Star, LogOut, User, Plus } from 'lucide-react';
 import { format } from 'date-fns';
 import { ar } from 'date-fns/locale';
+import { linkPushDevice, requestPushPermission } from '@/onesignal';
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
@@ -20,6 +21,7 @@ const PatientDashboard = ({ user, onLogout }) => {
   const [doctors, setDoctors] = useState([]);
   const [services, setServices] = useState([]);
   const [notifications, setNotifications] = useState([]);
+  const [unreadCount, setUnreadCount] = useState(0);
   const [loading, setLoading] = useState(true);
   const [showBookDialog, setShowBookDialog] = useState(false);
   const [showNotificationPrompt, setShowNotificationPrompt] = useState(false);
@@ -38,29 +40,46 @@ const PatientDashboard = ({ user, onLogout }) => {
   }, []);
 
   const checkNotificationPermission = async () => {
-    // Notifications disabled temporarily for native build
-    console.log('Push notifications will be added in future update');
-    setShowNotificationPrompt(false);
+    // Pushes are addressed to the patient's user id, so link this device to it
+    const granted = await linkPushDevice(user);
+    if (granted === null) {
+      // Web push unavailable (e.g. the native build)
+      setShowNotificationPrompt(false);
+      return;
+    }
+    setNotificationPermission(granted ? 'granted' : 'default');
+    setShowNotificationPrompt(!granted);
   };
 
   const handleEnableNotifications = async () => {
-    // Notifications disabled temporarily for native build
-    console.log('Push notifications will be added in future update');
-    toast.info('الإشعارات ستتوفر في التحديث القادم');
+    const granted = await requestPushPermission(user);
+    if (granted === null) {
+      toast.info('الإشعارات ستتوفر في التحديث القادم');
+      return;
+    }
+    if (granted) {
+      setNotificationPermission('granted');
+      setShowNotificationPrompt(false);
+      toast.success('تم تفعيل الإشعارات');
+    } else {
+      toast.error('لم يتم السماح بالإشعارات، يمكنك تفعيلها من إعدادات المتصفح');
+    }
   };
 
   const fetchData = async () => {
     try {
-      const [appointmentsRes, doctorsRes, servicesRes, notificationsRes] = await Promise.all([
+      const [appointmentsRes, doctorsRes, servicesRes, notificationsRes, unreadRes] = await Promise.all([
         axios.get(`${API}/appointments?patient_phone=${user.phone}`),
         axios.get(`${API}/doctors`),
         axios.get(`${API}/services`),
-        axios.get(`${API}/notifications?user_id=${user.id}`)
+        axios.get(`${API}/notifications?user_id=${user.id}`),
+        axios.get(`${API}/notifications/unread-count?user_id=${user.id}`)
       ]);
       setAppointments(appointmentsRes.data);
       setDoctors(doctorsRes.data);
       setServices(servicesRes.data);
       setNotifications(notificationsRes.data);
+      setUnreadCount(unreadRes.data.unread);
     } catch (error) {
       toast.error('خطأ في تحميل البيانات');
     } finally {
@@ -71,13 +90,16 @@ const PatientDashboard = ({ user, onLogout }) => {
   const handleBookAppointment = async (e) => {
     e.preventDefault();
     try {
-      // Create a temporary datetime (will be updated by admin later)
-      const tempDate = new Date(newAppointment.preferred_date);
-      // Set time based on period
-      if (newAppointment.preferred_time_period === 'morning') {
-        tempDate.setHours(9, 0, 0); // 9 AM
-      } else {
-        tempDate.setHours(16, 0, 0); // 4 PM
+      // Take the first free slot of the preferred period (the admin can move it later)
+      const day = newAppointment.preferred_date;
+      const availability = await axios.get(`${API}/doctors/${newAppointment.doctor_id}/availability`, {
+        params: { start: day, end: day, service_id: newAppointment.service_id }
+      });
+      const slots = availability.data.days.flatMap(d => d.slots);
+      const slot = slots.find(s => (new Date(s).getHours() < 12) === (newAppointment.preferred_time_period === 'morning'));
+      if (!slot) {
+        toast.error('لا توجد مواعيد متاحة في هذه الفترة، يرجى اختيار يوم أو فترة أخرى');
+        return;
       }
       
       const timePeriodText = newAppointment.preferred_time_period === 'morning' ? 'صباحاً' : 'مساءً';
@@ -89,7 +111,7 @@ const PatientDashboard = ({ user, onLogout }) => {
         patient_phone: user.phone,
         doctor_id: newAppointment.doctor_id,
         service_id: newAppointment.service_id,
-        appointment_date: tempDate.toISOString(),
+        appointment_date: slot,
         notes: notesWithPeriod,
         created_by: 'patient'
       });
@@ -98,7 +120,25 @@ const PatientDashboard = ({ user, onLogout }) => {
       setNewAppointment({ doctor_id: '', service_id: '', preferred_date: '', preferred_time_period: '', notes: '' });
       fetchData();
     } catch (error) {
-      toast.error('خطأ في حجز الموعد');
+      if (error.response?.status === 409) {
+        toast.error('هذا الموعد محجوز، يرجى المحاولة مرة أخرى');
+      } else {
+        toast.error('خطأ في حجز الموعد');
+      }
+    }
+  };
+
+  const handleTabChange = async (tab) => {
+    if (tab !== 'notifications' || unreadCount === 0 || notifications.length === 0) return;
+    try {
+      // Everything up to the newest notification on screen has now been seen
+      const res = await axios.post(`${API}/notifications/read`, {
+        user_id: user.id,
+        before: notifications[0].created_at
+      });
+      setUnreadCount(res.data.unread);
+    } catch (error) {
+      console.error('Error marking notifications as read:', error);
     }
   };
 
@@ -281,7 +321,7 @@ const PatientDashboard = ({ user, onLogout }) => {
         </div>
 
         {/* Tabs */}
-        <Tabs defaultValue="upcoming" className="space-y-6">
+        <Tabs defaultValue="upcoming" className="space-y-6" onValueChange={handleTabChange}>
           <TabsList className="grid w-full max-w-md grid-cols-3">
             <TabsTrigger value="upcoming" data-testid="upcoming-tab">
               <Calendar className="w-4 h-4 ml-2" />
@@ -294,6 +334,11 @@ const PatientDashboard = ({ user, onLogout }) => {
             <TabsTrigger value="notifications" data-testid="notifications-tab">
               <Bell className="w-4 h-4 ml-2" />
               الإشعارات
+              {unreadCount > 0 && (
+                <span className="mr-2 bg-red-600 text-white text-xs rounded-full px-2" data-testid="unread-badge">
+                  {unreadCount}
+                </span>
+              )}
             </TabsTrigger>
           </TabsList>
 
@@ -345,7 +390,7 @@ const PatientDashboard = ({ user, onLogout }) => {
                       setShowBookDialog(true);
                     }
                     // Mark as read
-                    axios.put(`${API}/notifications/${notif.id}/read`);
+                    axios.put(`${API}/notifications/${notif.id}/read?user_id=${user.id}`);
                   }}
                 >
                   <CardHeader>
@@ -0,0 +1,251 @@
+import asyncio
+import contextlib
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost")
+os.environ.setdefault("DB_NAME", "test_server")
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+import motor.motor_asyncio  # noqa: E402
+
+motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+import server  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+SLOT = datetime(2030, 1, 1, 9, tzinfo=timezone.utc)
+
+
+async def seed():
+    created_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    for name in ("appointments", "reservations", "doctors", "services", "admin_users"):
+        await server.db[name].delete_many({})
+    await server.db.reservations.create_indexes(server.INDEX_REGISTRY["reservations"])
+    await server.db.doctors.insert_one({"id": "d", "name": "D", "specialization": "g", "available_days": [], "created_at": created_at})
+    await server.db.services.insert_one({"id": "s", "name": "S", "name_en": "S", "duration_minutes": 30, "created_at": created_at})
+    await server.db.admin_users.insert_one({"id": "a", "username": "a", "role": "admin", "name": "A"})
+    await server.catalog_cache.load()
+
+
+@pytest.fixture
+def client():
+    asyncio.run(seed())
+    token = server.create_access_token({"user_id": "a", "role": "admin"})
+    return TestClient(server.app, headers={"Authorization": f"Bearer {token}"})
+
+
+def book(client, minutes):
+    response = client.post("/api/appointments", json={
+        "patient_name": "p",
+        "patient_phone": "0500000000",
+        "doctor_id": "d",
+        "service_id": "s",
+        "appointment_date": (SLOT + timedelta(minutes=minutes)).isoformat(),
+    })
+    assert response.status_code == 200
+    return response.json()
+
+
+async def reservations():
+    return sorted([
+        (r["appointment_id"], r["slot_start"])
+        async for r in server.db.reservations.find({}, {"_id": 0})
+    ])
+
+
+def test_move_onto_taken_slot_leaves_appointment_untouched(client):
+    first = book(client, 0)
+    book(client, 60)
+    held = asyncio.run(reservations())
+
+    response = client.put(f"/api/appointments/{first['id']}", json={
+        "appointment_date": (SLOT + timedelta(minutes=60)).isoformat(),
+        "version": 0,
+    })
+    assert response.status_code == 409
+
+    stored = asyncio.run(server.db.appointments.find_one({"id": first["id"]}, {"_id": 0}))
+    assert stored["appointment_date"] == SLOT
+    assert stored.get("version", 0) == 0
+    assert asyncio.run(reservations()) == held
+
+
+def test_move_onto_free_slot_moves_reservations(client):
+    first = book(client, 0)
+
+    response = client.put(f"/api/appointments/{first['id']}", json={
+        "appointment_date": (SLOT + timedelta(minutes=120)).isoformat(),
+        "version": 0,
+    })
+    assert response.status_code == 200
+    assert response.json()["version"] == 1
+
+    slots = [slot for _, slot in asyncio.run(reservations())]
+    assert slots and min(slots) == SLOT + timedelta(minutes=120)
+
+
+def test_stale_version_takes_no_reservations(client):
+    first = book(client, 0)
+    held = asyncio.run(reservations())
+
+    response = client.put(f"/api/appointments/{first['id']}", json={
+        "appointment_date": (SLOT + timedelta(minutes=120)).isoformat(),
+        "version": 5,
+    })
+    assert response.status_code == 409
+    assert asyncio.run(reservations()) == held
+
+
+def test_bulk_move_releases_old_slots_after_write(client):
+    first = book(client, 0)
+
+    response = client.post("/api/appointments/bulk", json={"operations": [{
+        "appointment_id": first["id"],
+        "update": {"appointment_date": (SLOT + timedelta(minutes=120)).isoformat(), "version": 0},
+    }]})
+    assert response.status_code == 200
+    assert response.json()[0]["status_code"] == 200
+
+    slots = [slot for _, slot in asyncio.run(reservations())]
+    assert slots and min(slots) == SLOT + timedelta(minutes=120)
+
+
+def test_two_reminder_engines_send_each_reminder_once(client, monkeypatch):
+    # Each worker process has its own lock, so nothing in-process serializes them
+    monkeypatch.setattr(server, "reminder_lock", contextlib.nullcontext())
+    due = datetime.now(timezone.utc) + timedelta(hours=23)
+    apt = {
+        "id": "r", "patient_id": "u", "patient_name": "p", "patient_phone": "0500000000",
+        "doctor_id": "d", "doctor_name": "D", "service_id": "s", "service_name": "S",
+        "appointment_date": due, "status": "confirmed", "version": 0,
+    }
+
+    async def run():
+        await server.db.outbox.delete_many({})
+        await server.db.appointments.insert_one(apt)
+        engines = [server.ReminderEngine(), server.ReminderEngine()]
+        for engine in engines:
+            await engine.rebuild()
+        await asyncio.gather(*(engine._fire_due() for engine in engines))
+        return (
+            await server.db.outbox.count_documents({"kind": "reminder"}),
+            await server.db.appointments.find_one({"id": "r"}, {"_id": 0}),
+        )
+
+    queued, stored = asyncio.run(run())
+    assert queued == 1
+    assert stored["reminder_24h_sent"] is True
+
+
+def test_service_missing_from_cache_reserves_its_real_duration(client):
+    # Created by another worker: in MongoDB but not in this worker's catalog cache yet
+    asyncio.run(server.db.services.insert_one({
+        "id": "long", "name": "L", "name_en": "L", "duration_minutes": 90,
+        "created_at": datetime(2025, 1, 1, tzinfo=timezone.utc),
+    }))
+    response = client.post("/api/appointments", json={
+        "patient_name": "p",
+        "patient_phone": "0500000000",
+        "doctor_id": "d",
+        "service_id": "long",
+        "appointment_date": SLOT.isoformat(),
+    })
+    assert response.status_code == 200
+
+    response = client.post("/api/appointments", json={
+        "patient_name": "q",
+        "patient_phone": "0500000001",
+        "doctor_id": "d",
+        "service_id": "s",
+        "appointment_date": (SLOT + timedelta(minutes=60)).isoformat(),
+    })
+    assert response.status_code == 409
+
+
+def test_longer_service_extends_upcoming_reservations(client):
+    book(client, 0)
+
+    response = client.put("/api/services/s", json={"duration_minutes": 60})
+    assert response.status_code == 200
+
+    slots = [slot for _, slot in asyncio.run(reservations())]
+    assert max(slots) == SLOT + timedelta(minutes=60 - server.SLOT_MINUTES)
+
+
+def test_mark_read_accepts_naive_before(client):
+    now = datetime.now(timezone.utc)
+
+    async def seed_inbox():
+        for name in ("notifications", "notification_counters", "campaigns"):
+            await server.db[name].delete_many({})
+        server.broadcast_cache.clear()
+        notification = server.Notification(user_id="u", title="n", message="m", type="general", created_at=now - timedelta(hours=1))
+        await server.db.notifications.insert_one(server.to_document(notification))
+        await server.bump_unread({"u": 1})
+        campaign = server.Campaign(title="c", message="m", target_audience="all", created_by="a", broadcast_at=now - timedelta(hours=1))
+        await server.db.campaigns.insert_one(server.to_document(campaign))
+
+    asyncio.run(seed_inbox())
+    before = (now + timedelta(minutes=1)).replace(tzinfo=None).isoformat()
+
+    response = client.post("/api/notifications/read", json={"user_id": "u", "before": before})
+    assert response.status_code == 200
+    assert response.json() == {"marked": 1, "unread": 0}
+    assert client.get("/api/notifications/unread-count", params={"user_id": "u", "refresh": True}).json()["unread"] == 0
+
+
+def test_status_edits_take_one_round_trip_unless_cancelled(client, monkeypatch):
+    first = book(client, 0)
+    reads = []
+    versioned_find = server.versioned_find
+
+    async def counting_find(*args, **kwargs):
+        reads.append(args[2])
+        return await versioned_find(*args, **kwargs)
+
+    monkeypatch.setattr(server, "versioned_find", counting_find)
+
+    response = client.put(f"/api/appointments/{first['id']}", json={"status": "confirmed", "version": 0})
+    assert response.status_code == 200
+    assert response.json()["version"] == 1
+    assert reads == []
+
+    response = client.put(f"/api/appointments/{first['id']}", json={"status": "cancelled", "version": 1})
+    assert response.status_code == 200
+    assert asyncio.run(reservations()) == []
+
+    # Leaving cancelled has to take the slots again first
+    response = client.put(f"/api/appointments/{first['id']}", json={"status": "confirmed", "version": 2})
+    assert response.status_code == 200
+    assert response.json()["version"] == 3
+    assert asyncio.run(reservations())
+    assert reads == [first["id"], first["id"]]
+
+    response = client.put(f"/api/appointments/{first['id']}", json={"status": "completed", "version": 2})
+    assert response.status_code == 409
+
+
+def test_bulk_lost_update_check_ignores_sub_millisecond_dates(client, monkeypatch):
+    moved = book(client, 0)
+    raced = book(client, 60)
+    reserve_bulk_slots = server.reserve_bulk_slots
+
+    async def edited_meanwhile(planned, results):
+        kept = await reserve_bulk_slots(planned, results)
+        await server.db.appointments.update_one({"id": raced["id"]}, {"$inc": {"version": 1}})
+        return kept
+
+    monkeypatch.setattr(server, "reserve_bulk_slots", edited_meanwhile)
+
+    response = client.post("/api/appointments/bulk", json={"operations": [
+        {"appointment_id": moved["id"], "update": {
+            "appointment_date": (SLOT + timedelta(minutes=120, microseconds=123456)).isoformat(), "version": 0,
+        }},
+        {"appointment_id": raced["id"], "update": {"notes": "n", "version": 0}},
+    ]})
+    assert [result["status_code"] for result in response.json()] == [200, 409]